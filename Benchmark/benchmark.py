@@ -0,0 +1,227 @@
+"""
+Stage-by-stage benchmark of the data and evaluation pipeline on synthetic power-law datasets.
+
+    python benchmark.py --scales 10000 100000 1000000 10000000 --model art
+
+Every scale is generated once under --data_dir and then measured in its own process, so the
+peak RSS of a record only covers that scale. Records go to a JSONL stream (one per stage and
+scale, see telemetry.py) and are summarized as a throughput table with log-log scaling slopes.
+--train additionally runs the model script on the dataset and collects its own telemetry
+for the first training epochs.
+"""
+import argparse
+import glob
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+import generate_data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATASETS = {'art': 'Art', 'beauty': 'amazon-beauty', 'taobao': 'Taobao'}
+
+
+def model_dir(model):
+    return os.path.join(ROOT, 'Model-' + model)
+
+
+def bench_scale(args):
+    # runs in a child process, one per scale
+    sys.path.insert(0, model_dir(args.model))
+    from load_data import Data
+    from telemetry import Telemetry
+    from metrics import pad_candidates, ranking_metrics, full_ranking_metrics
+    from inference import propagate
+
+    path = os.path.join(args.data_dir, str(args.scale))
+    telemetry = Telemetry(args.results, scale=args.scale, model=args.model, bench=args.bench_id)
+    rng = np.random.RandomState(0)
+
+    if os.path.exists(path + '/cache'):
+        shutil.rmtree(path + '/cache')
+    t = time.time()
+    data = Data(path=path, batch_size=args.batch_size, n_workers=args.n_workers)
+    n_edges = data.n_train + data.n_test
+    telemetry.emit('load_cold', time.time() - t, edges=n_edges, n_users=data.n_users, n_items=data.n_items)
+    with telemetry.stage('load_warm', edges=n_edges):
+        data = Data(path=path, batch_size=args.batch_size, n_workers=args.n_workers)
+
+    # small scales have fewer users than a batch, batches hold distinct users
+    batch_size = data.batch_size = min(args.batch_size, len(data.exist_users))
+
+    with telemetry.stage('get_adj_mat', edges=data.n_train):
+        R, degree = data.get_adj_mat()
+    if not args.skip_create_adj_mat:
+        with telemetry.stage('create_adj_mat', edges=data.n_train):
+            data.create_adj_mat()
+
+    n_batch = data.n_train // batch_size + 1
+    with telemetry.stage('sample_epoch', samples=n_batch * batch_size):
+        data.sample_epoch(n_batch, rng)
+    n_single = min(n_batch, 50)
+    with telemetry.stage('sample_u', samples=n_single * batch_size):
+        for _ in range(n_single):
+            data.sample_u(rng)
+
+    # one propagation layer of a 64-wide tower over R, the unit of work of every SpMM in the model
+    u_embed = rng.randn(data.n_users, 64).astype(np.float32)
+    i_embed = rng.randn(data.n_items, 64).astype(np.float32)
+    with telemetry.stage('propagate_64', edges=2 * data.n_train):
+        propagate(R, degree[:data.n_users], degree[data.n_users:], u_embed, i_embed, (-0.5, -0.5))
+
+    # evaluation on random fused embeddings, same width as the exported ones
+    users = list(data.test_set.keys())
+    ua = rng.randn(data.n_users, 576).astype(np.float32)
+    ia = rng.randn(data.n_items, 576).astype(np.float32)
+    with telemetry.stage('eval_candidates_build', samples=len(users)):
+        data.eval_candidates(users[:1])
+    with telemetry.stage('eval_sampled', samples=len(users)):
+        for start in range(0, len(users), 2 * batch_size):
+            user_batch = users[start: start + 2 * batch_size]
+            candidates = pad_candidates(data.eval_candidates(user_batch))
+            scores = np.einsum('ud,ucd->uc', ua[np.asarray(user_batch)], ia[np.maximum(candidates, 0)])
+            scores[candidates < 0] = -np.inf
+            # eval_candidates puts the 99 negatives first and the test positives after them
+            ranking_metrics(scores, (np.arange(candidates.shape[1]) >= 99) & (candidates >= 0), np.arange(1, 21))
+
+    full_users = users[:args.full_users]
+    with telemetry.stage('eval_full', samples=len(full_users), edges=len(full_users) * data.n_items):
+        for start in range(0, len(full_users), 2 * batch_size):
+            full_ranking_metrics(lambda u, s, e: np.dot(ua[u], ia[s: e].T), full_users[start: start + 2 * batch_size],
+                                 R, data.test_set, np.arange(1, 21), args.item_chunk)
+    telemetry.close()
+
+
+def bench_train(args, path, scale):
+    # runs the unmodified model script against the dataset in a scratch directory and
+    # harvests its telemetry once the requested number of epochs is recorded
+    dataset = DATASETS[args.model]
+    # batches hold distinct training users, small scales train with a smaller batch
+    with open(os.path.join(path, 'train.txt')) as f:
+        n_users = sum(1 for line in f if line.strip())
+    env = dict(os.environ, CFDTBD_BATCH_SIZE=str(min(args.batch_size, n_users)))
+    work = tempfile.mkdtemp(prefix='cfdtbd-bench-')
+    try:
+        os.makedirs(os.path.join(work, 'Data'))
+        os.symlink(os.path.abspath(path), os.path.join(work, 'Data', dataset))
+        os.makedirs(os.path.join(work, 'Model'))
+        for file in glob.glob(os.path.join(model_dir(args.model), '*.py')):
+            os.symlink(file, os.path.join(work, 'Model', os.path.basename(file)))
+
+        stream = os.path.join(work, 'Model', 'Log', 'telemetry-{}.jsonl'.format(dataset))
+        proc = subprocess.Popen([sys.executable, 'model-{}.py'.format(args.model)], cwd=os.path.join(work, 'Model'),
+                                env=env)
+        records = []
+        t = time.time()
+        while proc.poll() is None and time.time() - t < args.train_timeout:
+            time.sleep(1)
+            if os.path.exists(stream):
+                with open(stream) as f:
+                    records = [json.loads(line) for line in f if line.strip()]
+                if sum(r['stage'] == 'train_epoch' for r in records) >= args.train_epochs:
+                    break
+        if proc.poll() is None:
+            proc.terminate()
+            proc.wait()
+        elif proc.returncode != 0:
+            print('model script exited with code %d at scale %d, %d training epochs recorded' % (
+                proc.returncode, scale, sum(r['stage'] == 'train_epoch' for r in records)))
+
+        with open(args.results, 'a') as f:
+            for r in records:
+                r.update(scale=scale, model=args.model, bench=args.bench_id, stage='train/' + r['stage'])
+                f.write(json.dumps(r) + '\n')
+    finally:
+        shutil.rmtree(work)
+
+
+def summarize(results, bench_id, plot=None):
+    with open(results) as f:
+        records = [r for r in (json.loads(line) for line in f if line.strip()) if r.get('bench') == bench_id]
+    stages = []
+    for r in records:
+        if r['stage'] not in stages:
+            stages.append(r['stage'])
+    scales = sorted(set(r['scale'] for r in records))
+
+    print('%-32s' % 'stage' + ''.join('%22s' % s for s in scales) + '%8s' % 'slope')
+    curves = {}
+    for stage in stages:
+        by_scale = dict((r['scale'], r) for r in records if r['stage'] == stage)
+        cells = []
+        for s in scales:
+            r = by_scale.get(s)
+            if r is None:
+                cells.append('%22s' % '-')
+                continue
+            rate = r.get('samples_per_sec') or r.get('edges_per_sec')
+            cells.append('%22s' % ('%.3fs %s' % (r['seconds'], '%.3g/s' % rate if rate else '')))
+        # log-log slope of seconds against the dataset scale, 1.0 is linear scaling
+        xs = [s for s in scales if s in by_scale and by_scale[s]['seconds'] > 0]
+        slope = np.polyfit(np.log(xs), np.log([by_scale[s]['seconds'] for s in xs]), 1)[0] if len(xs) > 1 else float('nan')
+        curves[stage] = (xs, [by_scale[s]['seconds'] for s in xs])
+        print('%-32s' % stage + ''.join(cells) + '%8.2f' % slope)
+    print('%-32s' % 'peak rss (MB)' + ''.join(
+        '%22.0f' % max(r['peak_rss_mb'] for r in records if r['scale'] == s and not r['stage'].startswith('train/'))
+        for s in scales))
+
+    if plot:
+        try:
+            import matplotlib
+            matplotlib.use('Agg')
+            import matplotlib.pyplot as plt
+        except ImportError:
+            print('matplotlib is not installed, no scaling plot written')
+            return
+        for stage, (xs, ys) in curves.items():
+            plt.loglog(xs, ys, marker='o', label=stage)
+        plt.xlabel('interactions')
+        plt.ylabel('seconds')
+        plt.legend(fontsize=6)
+        plt.savefig(plot, dpi=150)
+        print('already write', plot)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[10000, 100000, 1000000, 10000000],
+                        help='number of interactions of each synthetic dataset')
+    parser.add_argument('--model', default='art', choices=sorted(DATASETS))
+    parser.add_argument('--data_dir', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+    parser.add_argument('--results', default='results.jsonl')
+    parser.add_argument('--alpha_user', type=float, default=1.0)
+    parser.add_argument('--alpha_item', type=float, default=1.0)
+    parser.add_argument('--batch_size', type=int, default=2048)
+    parser.add_argument('--n_workers', type=int, default=1, help='text parsing processes of the loader')
+    parser.add_argument('--item_chunk', type=int, default=65536)
+    parser.add_argument('--full_users', type=int, default=4096, help='users ranked against the full catalog')
+    parser.add_argument('--skip_create_adj_mat', action='store_true', help='do not time the normalized square adjacency')
+    parser.add_argument('--train', action='store_true', help='also time training epochs of the model script')
+    parser.add_argument('--train_epochs', type=int, default=1)
+    parser.add_argument('--train_timeout', type=float, default=3600.)
+    parser.add_argument('--plot', default=None, help='write a log-log scaling plot (needs matplotlib)')
+    parser.add_argument('--scale', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--bench_id', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        bench_scale(args)
+        sys.exit()
+
+    args.bench_id = args.bench_id or str(int(time.time()))
+    for scale in args.scales:
+        path = os.path.join(args.data_dir, str(scale))
+        if not os.path.exists(path + '/train.txt'):
+            # the loaders read 4096-d visual and 300-d title features
+            generate_data.generate(path, scale, alpha_user=args.alpha_user, alpha_item=args.alpha_item)
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), '--scale', str(scale),
+                               '--bench_id', args.bench_id] + sys.argv[1:])
+        if args.train:
+            bench_train(args, path, scale)
+
+    summarize(args.results, args.bench_id, args.plot)
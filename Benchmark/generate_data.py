@@ -0,0 +1,117 @@
+"""
+Synthetic datasets in the layout the loaders read (train.txt, test.txt, item2imgfeat.txt,
+itemtitle2vec.txt), with power-law user and item degree distributions.
+
+    python generate_data.py --out data/1000000 --n_interactions 1000000
+"""
+import argparse
+import os
+import time
+import numpy as np
+
+
+def power_law_weights(n, alpha, rng):
+    # p(rank) ~ rank^-alpha, randomly assigned to ids
+    w = np.arange(1, n + 1, dtype=np.float64) ** -alpha
+    rng.shuffle(w)
+    return w / w.sum()
+
+
+def sample_interactions(n_users, n_items, n_interactions, alpha_user, alpha_item, min_degree, rng, n_rounds=10):
+    # user degrees follow the power law within [min_degree, n_items / 2], rescaled so they add up to
+    # about n_interactions; items are drawn by popularity, duplicate pairs are dropped and topped up
+    user_p = power_law_weights(n_users, alpha_user, rng)
+    scale = float(n_interactions)
+    for _ in range(20):
+        degree = np.clip(np.round(user_p * scale), min_degree, max(min_degree, n_items // 2)).astype(np.int64)
+        if abs(degree.sum() - n_interactions) < 0.01 * n_interactions:
+            break
+        scale *= n_interactions / float(degree.sum())
+    item_p = power_law_weights(n_items, alpha_item, rng)
+
+    keys = np.zeros(0, dtype=np.int64)
+    missing = degree
+    for _ in range(n_rounds):
+        users = np.repeat(np.arange(n_users, dtype=np.int64), missing)
+        keys = np.unique(np.concatenate([keys, users * n_items + rng.choice(n_items, size=len(users), p=item_p)]))
+        missing = degree - np.bincount(keys // n_items, minlength=n_users)
+        if not missing.any():
+            break
+
+    users, items = keys // n_items, keys % n_items
+    # item ids are compacted so every id below n_items occurs in the data
+    _, items = np.unique(items, return_inverse=True)
+    return users, items.astype(np.int64), int(items.max()) + 1
+
+
+def split_leave_one_out(users, items, n_users, rng):
+    # one random interaction per user with at least two goes to the test set
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(users, minlength=n_users))
+    degree = np.diff(indptr)
+    has_test = np.nonzero(degree > 1)[0]
+    pick = indptr[has_test] + (rng.random_sample(len(has_test)) * degree[has_test]).astype(np.int64)
+    test = np.zeros(len(users), dtype=bool)
+    test[pick] = True
+    return test
+
+
+def write_lists(file, users, items, n_users):
+    indptr = np.zeros(n_users + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(users, minlength=n_users))
+    with open(file, 'w') as f:
+        for u in range(n_users):
+            row = items[indptr[u]: indptr[u + 1]]
+            if len(row):
+                f.write(str(u) + ' ' + ' '.join(map(str, row.tolist())) + '\n')
+
+
+def write_features(file, n_items, d, rng, chunk_size=1024):
+    fmt = ' '.join(['%d'] + ['%.4f'] * d)
+    with open(file, 'w') as f:
+        for start in range(0, n_items, chunk_size):
+            end = min(start + chunk_size, n_items)
+            feat = rng.randn(end - start, d).astype(np.float32)
+            np.savetxt(f, np.column_stack([np.arange(start, end), feat]), fmt=fmt)
+
+
+def generate(out, n_interactions, n_users=None, n_items=None, alpha_user=1.0, alpha_item=1.0,
+             min_degree=2, d1=4096, d2=300, seed=2024):
+    rng = np.random.RandomState(seed)
+    n_users = n_users or max(10, n_interactions // 10)
+    n_items = n_items or max(10, n_interactions // 40)
+    if not os.path.exists(out):
+        os.makedirs(out)
+
+    t = time.time()
+    users, items, n_items = sample_interactions(n_users, n_items, n_interactions, alpha_user, alpha_item,
+                                                min_degree, rng)
+    test = split_leave_one_out(users, items, n_users, rng)
+    write_lists(out + '/train.txt', users[~test], items[~test], n_users)
+    write_lists(out + '/test.txt', users[test], items[test], n_users)
+    write_features(out + '/item2imgfeat.txt', n_items, d1, rng)
+    write_features(out + '/itemtitle2vec.txt', n_items, d2, rng)
+    # the taobao loader reads the title vectors under this name
+    if not os.path.exists(out + '/itemtitle2vec300.txt'):
+        os.symlink('itemtitle2vec.txt', out + '/itemtitle2vec300.txt')
+
+    print('already generate %s: %d users, %d items, %d train, %d test, %.1fs' % (
+        out, n_users, n_items, int((~test).sum()), int(test.sum()), time.time() - t))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', required=True)
+    parser.add_argument('--n_interactions', type=int, required=True)
+    parser.add_argument('--n_users', type=int, default=None, help='default n_interactions / 10')
+    parser.add_argument('--n_items', type=int, default=None, help='default n_interactions / 40')
+    parser.add_argument('--alpha_user', type=float, default=1.0)
+    parser.add_argument('--alpha_item', type=float, default=1.0)
+    parser.add_argument('--min_degree', type=int, default=2)
+    parser.add_argument('--d1', type=int, default=4096, help='visual feature size, the loaders expect 4096')
+    parser.add_argument('--d2', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=2024)
+    args = parser.parse_args()
+
+    generate(args.out, args.n_interactions, args.n_users, args.n_items, args.alpha_user, args.alpha_item,
+             args.min_degree, args.d1, args.d2, args.seed)
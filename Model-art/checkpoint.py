@@ -0,0 +1,71 @@
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+
+class Checkpointer(object):
+    """
+    Training checkpoints stored as path/<name>.npz, one file holding the values of the given
+    variables (optimizer slots included) and a json state (epoch, early stopping, sampler position).
+    save() only snapshots the variables to numpy, the file is written by a background thread;
+    it waits when a previous snapshot is still queued.
+    """
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path)
+        # at most one snapshot waits while another is written, a save() on a slow disk blocks
+        # instead of piling up full copies of the variables
+        self._queue = queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._work)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _file(self, name):
+        return os.path.join(self.path, name + '.npz')
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            name, arrays = item
+            try:
+                # written aside and renamed, a crash mid-write keeps the previous checkpoint
+                np.savez(self._file(name + '.tmp'), **arrays)
+                os.rename(self._file(name + '.tmp'), self._file(name))
+            except Exception as e:
+                self._error = e
+
+    def save(self, sess, variables, name, state):
+        if self._error is not None:
+            raise self._error
+        values = sess.run(variables)
+        arrays = {'var_%d' % k: value for k, value in enumerate(values)}
+        arrays['state'] = np.array(json.dumps(dict(state, variables=[v.name for v in variables])))
+        self._queue.put((name, arrays))
+
+    def exists(self, name):
+        return os.path.exists(self._file(name))
+
+    def load_state(self, name):
+        with np.load(self._file(name)) as f:
+            return json.loads(str(f['state']))
+
+    def restore(self, sess, variables, name):
+        by_name = dict((v.name, v) for v in variables)
+        with np.load(self._file(name)) as f:
+            state = json.loads(str(f['state']))
+            for k, var_name in enumerate(state['variables']):
+                by_name[var_name].load(f['var_%d' % k], sess)
+        return state
+
+    def close(self):
+        # waits for the pending writes
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
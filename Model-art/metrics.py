@@ -0,0 +1,161 @@
+import ctypes
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+
+
+def pad_candidates(candidates, fill=-1):
+    # list of per-user candidate lists -> (n_users, max_len) int64 matrix padded with fill
+    lens = np.array([len(c) for c in candidates], dtype=np.int64)
+    mat = np.full((len(candidates), lens.max() if len(lens) else 0), fill, dtype=np.int64)
+    mat[np.arange(mat.shape[1]) < lens[:, None]] = np.concatenate(candidates) if len(lens) else []
+    return mat
+
+
+def top_k(scores, k):
+    """
+    Column indices of the k largest scores of every row, best first.
+    Ties are broken by the lower column index, the same order heapq.nlargest gives.
+    """
+    n, m = scores.shape
+    k = min(k, m)
+    if n == 0 or k == 0:
+        return np.zeros((n, k), dtype=np.int64)
+    rows = np.arange(n)[:, None]
+
+    # k-th largest score per row, then every score above it plus the earliest ties at it
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    kth = scores[rows, part].min(axis=1)[:, None]
+    above = scores > kth
+    at = scores == kth
+    need = k - above.sum(axis=1)[:, None]
+    selected = above | (at & (np.cumsum(at, axis=1) <= need))
+    idx = np.nonzero(selected)[1].reshape(n, k)
+
+    # stable sort of the selection keeps ascending column order within ties
+    order = np.argsort(-scores[rows, idx], axis=1, kind='mergesort')
+    return idx[rows, order]
+
+
+def ranking_metrics(scores, relevance, Ks):
+    """
+    HR, NDCG, precision, recall and MRR at every K in Ks for a batch of users.
+    scores: (n_users, n_candidates) float, padded candidates should score -inf.
+    relevance: (n_users, n_candidates) bool, True for the test positives.
+    Returns a dict of (n_users, len(Ks)) arrays and the top max(Ks) column indices.
+    """
+    top = top_k(scores, int(np.max(Ks)))
+    hits = relevance[np.arange(len(top))[:, None], top]
+    return _hit_metrics(hits, relevance.sum(axis=1), Ks), top
+
+
+def _hit_metrics(hits, n_rel, Ks):
+    # hits: (n_users, max(Ks)) bool relevance of the ranked top items, n_rel: positives per user
+    Ks = np.asarray(Ks)
+
+    # hits within the first k positions, for every k = 1..max(Ks)
+    n_hits = np.cumsum(hits, axis=1)[:, Ks - 1].astype(np.float64)
+    n_rel = np.asarray(n_rel)[:, None].astype(np.float64)
+
+    # rank of the first hit, max(Ks) when there is none
+    first = np.where(hits.any(axis=1), hits.argmax(axis=1), hits.shape[1])[:, None]
+    in_k = first < Ks[None, :]
+
+    # ndcg keeps the evaluation protocol's single-positive form: only the first hit counts
+    metrics = {'hit_ratio': (n_hits > 0).astype(np.float64),
+               'ndcg': np.where(in_k, np.log(2) / np.log(first + 2.), 0.),
+               'precision': n_hits / Ks[None, :],
+               'recall': n_hits / np.maximum(n_rel, 1.),
+               'mrr': np.where(in_k, 1. / (first + 1.), 0.)}
+    return metrics
+
+
+def full_ranking_metrics(rate_fn, users, R, test_set, Ks, item_chunk=65536):
+    """
+    Ranking metrics against the whole catalog for a batch of users.
+    rate_fn(users, start, end) returns the (n_users, end - start) scores of items start..end-1.
+    Items are scored chunk by chunk, training interactions are masked straight from the CSR R and
+    only a running top max(Ks) is kept, so memory is bounded by len(users) x item_chunk.
+    """
+    users = np.asarray(users, dtype=np.int64)
+    n_users, n_items = len(users), R.shape[1]
+    k = int(np.max(Ks))
+    rows = np.arange(n_users)[:, None]
+    train = R[users]
+
+    top_scores = np.zeros((n_users, 0), dtype=np.float32)
+    top_items = np.zeros((n_users, 0), dtype=np.int64)
+    for start in range(0, n_items, item_chunk):
+        end = min(start + item_chunk, n_items)
+        scores = np.asarray(rate_fn(users, start, end), dtype=np.float32)
+        seen = train[:, start:end].tocoo()
+        scores[seen.row, seen.col] = -np.inf
+
+        # running items precede the chunk and are already ordered, so ties still favour lower ids
+        scores = np.concatenate([top_scores, scores], axis=1)
+        items = np.concatenate([top_items, np.broadcast_to(np.arange(start, end), (n_users, end - start))], axis=1)
+        idx = top_k(scores, k)
+        top_scores, top_items = scores[rows, idx], items[rows, idx]
+
+    user_pos_test = [test_set[u] for u in users.tolist()]
+    n_rel = np.array([len(p) for p in user_pos_test], dtype=np.int64)
+    pos_keys = np.repeat(users, n_rel) * n_items + np.concatenate(user_pos_test)
+    hits = np.isin(users[:, None] * n_items + top_items, pos_keys)
+    return _hit_metrics(hits, n_rel, Ks), top_items
+
+
+_shared = {}
+
+
+def _init_worker(scores, relevance, Ks):
+    _shared['scores'], _shared['relevance'], _shared['Ks'] = scores, relevance, Ks
+
+
+def _range_metrics(task):
+    start, end, n_candidates = task
+    scores = np.frombuffer(_shared['scores'], dtype=np.float32)
+    relevance = np.frombuffer(_shared['relevance'], dtype=np.bool_)
+    return ranking_metrics(scores[start * n_candidates: end * n_candidates].reshape(end - start, n_candidates),
+                           relevance[start * n_candidates: end * n_candidates].reshape(end - start, n_candidates),
+                           _shared['Ks'])
+
+
+class MetricsPool(object):
+    """
+    Long-lived pool evaluating ranking_metrics on user ranges of a score batch.
+    The batch is copied once into shared RawArray buffers of max_users x max_candidates, workers
+    only receive (start, end) ranges; with n_workers=0 everything runs in the calling process.
+    """
+    def __init__(self, n_workers, max_users, max_candidates, Ks, chunk_size=256):
+        self.n_workers = n_workers
+        self.max_size = max_users * max_candidates
+        self.Ks = Ks
+        self.chunk_size = chunk_size
+        self.pool = None
+        if n_workers > 0:
+            self._scores = RawArray(ctypes.c_float, self.max_size)
+            self._relevance = RawArray(ctypes.c_bool, self.max_size)
+            self.pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                             initargs=(self._scores, self._relevance, Ks))
+
+    def run(self, scores, relevance):
+        n_users, n_candidates = scores.shape
+        if self.pool is None or n_users <= self.chunk_size:
+            return ranking_metrics(scores, relevance, self.Ks)
+        if n_users * n_candidates > self.max_size:
+            raise ValueError('score batch %s does not fit the shared buffer of %d' % (scores.shape, self.max_size))
+
+        np.frombuffer(self._scores, dtype=np.float32)[:scores.size] = scores.ravel()
+        np.frombuffer(self._relevance, dtype=np.bool_)[:relevance.size] = relevance.ravel()
+        tasks = [(start, min(start + self.chunk_size, n_users), n_candidates)
+                 for start in range(0, n_users, self.chunk_size)]
+        parts = self.pool.map(_range_metrics, tasks)
+
+        metrics = {name: np.concatenate([part[0][name] for part in parts]) for name in parts[0][0]}
+        return metrics, np.concatenate([part[1] for part in parts])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
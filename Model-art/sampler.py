@@ -0,0 +1,84 @@
+import threading
+import time
+import numpy as np
+
+
+class PrefetchSampler(object):
+    """
+    Produces BPR training batches ahead of time on background threads.
+    Batches are generated in blocks of block_size with Data.sample_epoch, block k always
+    drawn from np.random.RandomState([seed, k]), so the stream of (users, pos_items, neg_items)
+    is the same regardless of thread scheduling.
+    """
+    def __init__(self, data, seed, block_size=1, n_workers=2, prefetch=2, start_batch=0):
+        self.data = data
+        self.seed = seed
+        self.block_size = block_size
+        self.prefetch = prefetch
+        self.wait_time = 0.
+
+        self._n_consumed = start_batch
+        self._next_claim = start_batch // block_size
+        self._next_get = start_batch // block_size
+        self._offset = start_batch % block_size
+        self._block = None
+        self._ready = {}
+        self._error = None
+        self._cond = threading.Condition()
+
+        self._threads = []
+        for _ in range(n_workers):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    @property
+    def n_consumed(self):
+        return self._n_consumed
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._next_claim >= self._next_get + self.prefetch:
+                    self._cond.wait()
+                k = self._next_claim
+                self._next_claim += 1
+            try:
+                block = self.data.sample_epoch(self.block_size, np.random.RandomState([self.seed, k]))
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                self._ready[k] = block
+                self._cond.notify_all()
+
+    def get(self):
+        if self._block is None or self._offset == self.block_size:
+            t = time.time()
+            with self._cond:
+                while self._next_get not in self._ready:
+                    if self._error is not None:
+                        raise self._error
+                    self._cond.wait()
+                self._block = self._ready.pop(self._next_get)
+                self._next_get += 1
+                self._cond.notify_all()
+            self.wait_time += time.time() - t
+            self._offset %= self.block_size
+
+        users, pos_items, neg_items = self._block
+        batch = users[self._offset], pos_items[self._offset], neg_items[self._offset]
+        self._offset += 1
+        self._n_consumed += 1
+        return batch
+
+    def __iter__(self):
+        while True:
+            yield self.get()
+
+    def pop_wait_time(self):
+        wait_time, self.wait_time = self.wait_time, 0.
+        return wait_time
@@ -0,0 +1,84 @@
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024. * 1024. if sys.platform == 'darwin' else 1024.)
+
+
+def git_revision():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                      cwd=os.path.dirname(os.path.abspath(__file__)))
+        return out.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Telemetry(object):
+    """
+    Structured timing stream, one JSON object per line and per measured stage with its wall time,
+    peak RSS and optional throughputs. Every record carries the run fields (run id, dataset, commit)
+    so streams from different runs and commits can be appended to the same file and compared.
+    """
+    def __init__(self, path, **run):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'a')
+        self.run = {'run': int(time.time()), 'commit': git_revision()}
+        self.run.update(run)
+
+    def emit(self, stage, seconds, samples=None, edges=None, **fields):
+        record = {'stage': stage, 'time': time.time(), 'seconds': seconds, 'peak_rss_mb': peak_rss_mb()}
+        if samples is not None:
+            record['samples'] = samples
+            record['samples_per_sec'] = samples / seconds if seconds > 0 else None
+        if edges is not None:
+            record['edges'] = edges
+            record['edges_per_sec'] = edges / seconds if seconds > 0 else None
+        record.update(self.run)
+        record.update(fields)
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    @contextmanager
+    def stage(self, stage, samples=None, edges=None, **fields):
+        t = time.time()
+        yield
+        self.emit(stage, time.time() - t, samples, edges, **fields)
+
+    def close(self):
+        self.file.close()
+
+
+class StageTimer(object):
+    """
+    Accumulates the time spent in repeated phases (train steps, evaluation batches) so they are
+    emitted as one aggregated record per phase instead of one line per call.
+    """
+    def __init__(self):
+        self.seconds = {}
+        self.calls = {}
+        self.max = {}
+
+    @contextmanager
+    def __call__(self, phase):
+        t = time.time()
+        yield
+        dt = time.time() - t
+        self.seconds[phase] = self.seconds.get(phase, 0.) + dt
+        self.calls[phase] = self.calls.get(phase, 0) + 1
+        self.max[phase] = max(self.max.get(phase, 0.), dt)
+
+    def emit(self, telemetry, prefix, **fields):
+        for phase in sorted(self.seconds):
+            telemetry.emit(prefix + phase, self.seconds[phase], calls=self.calls[phase],
+                           mean_seconds=self.seconds[phase] / self.calls[phase], max_seconds=self.max[phase], **fields)
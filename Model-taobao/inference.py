@@ -0,0 +1,88 @@
+import json
+import numpy as np
+import scipy.sparse as sp
+
+
+def propagate(R, degree_u, degree_i, u_embeddings, i_embeddings, exponents):
+    # one layer over the [[I, R], [R^T, I]] graph, same normalization as Model._propagate
+    d1, d2 = exponents
+    u_side = u_embeddings * np.power(degree_u, d2)[:, None]
+    i_side = i_embeddings * np.power(degree_i, d2)[:, None]
+
+    u_embeddings = u_side + R.dot(i_side)
+    i_embeddings = i_side + R.T.dot(u_side)
+
+    return u_embeddings * np.power(degree_u, d1)[:, None], i_embeddings * np.power(degree_i, d1)[:, None]
+
+
+class InferenceModel(object):
+    """
+    TF-free forward pass of a trained CFDTBD model, loaded from the directory written by export_model.
+    Reproduces ua_embeddings*/ia_embeddings* and batch_ratings with NumPy/SciPy. Features default to
+    the dataset cache files recorded at export time and are only read once, while building the item side.
+    """
+    def __init__(self, path, img_feat=None, text_feat=None):
+        with open(path + '/config.json') as f:
+            self.config = json.load(f)
+        self.weights = dict(np.load(path + '/weights.npz'))
+
+        n_users, n_items = self.config['n_users'], self.config['n_items']
+        self.R = sp.csr_matrix((np.ones(len(self.weights['R_indices']), dtype=np.float32),
+                                self.weights['R_indices'], self.weights['R_indptr']), shape=(n_users, n_items))
+        self.degree_u = self.weights['degree'][:n_users]
+        self.degree_i = self.weights['degree'][n_users:]
+
+        if img_feat is None:
+            img_feat = np.load(self.config['img_feat'], mmap_mode='r')
+        if text_feat is None:
+            text_feat = np.load(self.config['text_feat'], mmap_mode='r')
+
+        self._build(img_feat, text_feat)
+
+    def _project(self, feat, name):
+        # feat @ w, followed by the exported per-batch ZCA matrices when the tower is whitened
+        w = self.weights['w%s_%s' % (name[1], name[0])]
+        X = np.dot(feat, w).astype(np.float32)
+        if name not in self.config['whitened']:
+            return X
+        batch_size = self.config['zca_batch_size']
+        return np.concatenate([np.dot(X[start: start + batch_size], self.weights['zca_%s_%d' % (name, k)])
+                               for k, start in enumerate(range(0, X.shape[0], batch_size))], axis=0)
+
+    def _propagate(self, u_embeddings, i_embeddings, exponents, n_layers):
+        for k in range(n_layers):
+            u_embeddings, i_embeddings = propagate(self.R, self.degree_u, self.degree_i,
+                                                   u_embeddings, i_embeddings, exponents)
+        return u_embeddings, i_embeddings
+
+    def _build(self, img_feat, text_feat):
+        config, weights = self.config, self.weights
+
+        self.ua_embeddings, self.ia_embeddings = self._propagate(weights['user_embedding'], weights['item_embedding'],
+                                                                 config['adj_exp'], config['n_layers'])
+
+        towers = {}
+        for name, exp in [('v1', 'adj_exp_com'), ('t1', 'adj_exp_com'), ('v2', 'adj_exp_dif'), ('t2', 'adj_exp_dif')]:
+            feat = img_feat if name[0] == 'v' else text_feat
+            towers[name] = self._propagate(weights['user_embedding_' + name], self._project(feat, name),
+                                           config[exp], 1)
+
+        um_m = np.concatenate([towers[name][0] for name in ['v1', 't1', 'v2', 't2']], axis=1)
+        im_m = np.concatenate([towers[name][1] for name in ['v1', 't1', 'v2', 't2']], axis=1)
+        self.ua_embeddings_m, self.ia_embeddings_m = self._propagate(um_m, im_m, config['adj_exp_m'], 1)
+
+        self.ua_embeddings_v = np.concatenate([towers['v1'][0], towers['v2'][0]], axis=1)
+        self.ia_embeddings_v = np.concatenate([towers['v1'][1], towers['v2'][1]], axis=1)
+        self.ua_embeddings_t = np.concatenate([towers['t1'][0], towers['t2'][0]], axis=1)
+        self.ia_embeddings_t = np.concatenate([towers['t1'][1], towers['t2'][1]], axis=1)
+
+        lambda_v, lambda_t, lambda_m = config['lambda_v'], config['lambda_t'], config['lambda_m']
+        self.ua_embeddings_fused = np.concatenate([self.ua_embeddings, lambda_v*self.ua_embeddings_v,
+                                                   lambda_t*self.ua_embeddings_t, lambda_m*self.ua_embeddings_m], axis=1)
+        self.ia_embeddings_fused = np.concatenate([self.ia_embeddings, self.ia_embeddings_v,
+                                                   self.ia_embeddings_t, self.ia_embeddings_m], axis=1)
+
+    def batch_ratings(self, users, items=None):
+        ua = self.ua_embeddings_fused[users]
+        ia = self.ia_embeddings_fused if items is None else self.ia_embeddings_fused[items]
+        return np.dot(ua, ia.T)
@@ -5,6 +5,10 @@ import time
 import collections
 import pickle
 import os
+import shutil
+import multiprocessing
+import json
+import hashlib
 
 seed = 2024
 
@@ -12,8 +16,111 @@ np.random.seed(seed)
 os.environ['PYTHONHASHSEED'] = str(seed)
 rd.seed(seed)
 
+CACHE_VERSION = 2
+
+
+def file_md5(file, chunk_size=1 << 24):
+    md5 = hashlib.md5()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def _sorted_member(keys, query):
+    # keys[searchsorted] == query with the query sorted first, searchsorted runs several times
+    # faster on a sorted query; the result is scattered back to the query order
+    order = np.argsort(query, axis=None, kind='quicksort')
+    flat = query.ravel()[order]
+    found = np.minimum(np.searchsorted(keys, flat), len(keys) - 1)
+    member = np.empty(query.size, dtype=bool)
+    member[order] = keys[found] == flat
+    return member.reshape(query.shape)
+
+
+def _parse_block(buf):
+    # buf holds complete `uid item item ...` lines, returns the uid, the number of items
+    # and the flattened items of every non-blank line
+    b = np.frombuffer(buf, dtype=np.uint8)
+    space = (b == 32) | (b == 10) | (b == 13) | (b == 9)
+    starts = np.flatnonzero(~space & np.concatenate(([True], space[:-1])))
+    if not len(starts):
+        # only blank lines, fromstring would read them as a single 0
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    tokens = np.fromstring(buf, dtype=np.int64, sep=' ')
+    if len(tokens) != len(starts):
+        raise ValueError('malformed interaction line near: %r' % buf[:80])
+    newlines = np.flatnonzero(b == 10)
+    line_of = np.searchsorted(newlines, starts)
+    counts = np.bincount(line_of, minlength=len(newlines) + 1)
+    counts = counts[counts > 0]
+
+    heads = np.zeros(len(counts), dtype=np.int64)
+    heads[1:] = np.cumsum(counts)[:-1]
+    is_item = np.ones(len(tokens), dtype=bool)
+    is_item[heads] = False
+    return tokens[heads], counts - 1, tokens[is_item]
+
+
+def _parse_range(args):
+    file, start, end, chunk_size = args
+    uids, lens, items = [], [], []
+    with open(file, 'rb') as f:
+        f.seek(start)
+        rest = b''
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            buf = rest + chunk
+            # only complete lines are parsed, the tail is carried over to the next read
+            cut = len(buf) if remaining <= 0 else buf.rfind(b'\n') + 1
+            rest = buf[cut:]
+            if cut > 0:
+                for out, part in zip((uids, lens, items), _parse_block(buf[:cut])):
+                    out.append(part)
+        if rest:
+            for out, part in zip((uids, lens, items), _parse_block(rest)):
+                out.append(part)
+    if not uids:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+    return np.concatenate(uids), np.concatenate(lens), np.concatenate(items)
+
+
+def parse_interactions(file, n_workers=1, chunk_size=1 << 24):
+    # single streaming pass over a `uid item item ...` file, returns int32 arrays
+    # (uids, indptr, indices) with one CSR row per line in file order
+    size = os.path.getsize(file)
+    bounds = [0]
+    if n_workers > 1 and size > chunk_size:
+        with open(file, 'rb') as f:
+            for k in range(1, n_workers):
+                f.seek(max(size * k // n_workers, bounds[-1]))
+                f.readline()
+                bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    ranges = [(file, bounds[k], bounds[k + 1], chunk_size) for k in range(len(bounds) - 1)]
+
+    if len(ranges) > 1:
+        pool = multiprocessing.Pool(min(n_workers, len(ranges)))
+        parts = pool.map(_parse_range, ranges)
+        pool.close()
+    else:
+        parts = [_parse_range(r) for r in ranges]
+
+    uids = np.concatenate([p[0] for p in parts]).astype(np.int32)
+    lens = np.concatenate([p[1] for p in parts])
+    indices = np.concatenate([p[2] for p in parts]).astype(np.int32)
+    indptr = np.zeros(len(uids) + 1, dtype=np.int32)
+    indptr[1:] = np.cumsum(lens)
+    return uids, indptr, indices
+
+
 class Data(object):
-    def __init__(self, path, batch_size):
+    def __init__(self, path, batch_size, n_workers=1):
         title_enable = True
 
         if 'movie' in path:
@@ -26,6 +133,7 @@ class Data(object):
         self.path = path
 
         self.batch_size = batch_size
+        self.n_workers = n_workers
 
         train_file = path + '/train.txt'
         test_file = path + '/test.txt'
@@ -45,200 +153,399 @@ class Data(object):
 
         self.exist_users = []
 
-        with open(train_file) as f:
-            for l in f.readlines():
-                if len(l) > 0:
-                    l = l.strip('\n').split(' ')
-                    items = [int(i) for i in l[1:]]
-                    uid = int(l[0])
-                    self.exist_users.append(uid)
-                    self.n_items = max(self.n_items, max(items))
-                    self.n_users = max(self.n_users, uid)
-                    self.n_train += len(items)
-
-        with open(test_file) as f:
-            for l in f.readlines():
-                if len(l) > 0:
-                    l = l.strip('\n')
-                    try:
-                        items = [int(i) for i in l.split(' ')[1:]]
-                    except Exception:
-                        continue
-                    self.n_items = max(self.n_items, max(items))
-                    self.n_test += len(items)
-
-        self.n_items += 1
-        self.n_users += 1
+        # compiled binary copy of the text files, rebuilt whenever a source file changes
+        self.cache_path = path + '/cache'
+        sources = {'train': train_file, 'test': test_file, 'img_feat': img_feat_file}
+        if title_enable:
+            sources['text_feat'] = text_feat_file
+
+        t1 = time.time()
+        if self._load_cache(sources):
+            print('already load dataset cache', time.time() - t1)
+        else:
+            # everything under cache/ is derived from the source files, drop stale leftovers
+            if os.path.exists(self.cache_path):
+                shutil.rmtree(self.cache_path)
+            os.mkdir(self.cache_path)
+            arrays = self._load_text(train_file, test_file, img_feat_file, text_feat_file, title_enable, d1, d2)
+            self._save_cache(sources, arrays)
+            print('already compile dataset cache', time.time() - t1)
 
         self.exist_items = list(range(self.n_items))
 
-        self.R = sp.dok_matrix((self.n_users, self.n_items), dtype=np.float32)
-
-        self.train_items, self.test_set = {}, {}
-        self.train_users = {}
-        self.train_users_f = {}
-
-        with open(train_file) as f:
-            for l in f.readlines():
-                if len(l) > 0:
-                    l = l.strip('\n').split(' ')
-                    items = [int(i) for i in l[1:]]
-                    uid = int(l[0])
-                    for i in items:
-                        if i not in self.train_users_f:
-                            self.train_users_f[i] = []
-                        else:
-                            self.train_users_f[i].append(uid)
-
-        with open(train_file) as f_train:
-            with open(test_file) as f_test:
-                for l in f_train.readlines():
-                    if len(l) == 0: break
-                    l = l.strip('\n')
-                    items = [int(i) for i in l.split(' ')]
-                    uid, train_items = items[0], items[1:]
-
-                    for i in train_items:
-                        self.R[uid, i] = 1.
-
-                        if i not in self.train_users:
-                            self.train_users[i] = []
-                        self.train_users[i].append(uid)
-
-                    self.train_items[uid] = train_items
-
-                for l in f_test.readlines():
-                    if len(l) == 0: break
-                    l = l.strip('\n')
-                    try:
-                        items = [int(i) for i in l.split(' ')]
-                    except Exception:
-                        continue
-
-                    uid, test_items = items[0], items[1:]
-                    self.test_set[uid] = test_items
-
-        self.img_features = {}
-        with open(img_feat_file, 'r') as file:
-            for line in file.readlines():
-                l = line.strip().split(' ')
-                item_id = l[0]
-                img_feat = list(map(float, l[1:]))
-                self.img_features[int(item_id)] = img_feat
-            self.imageFeaMatrix = [[0.] * d1] * self.n_items
-            for item in self.img_features:
-                self.imageFeaMatrix[item] = self.img_features[item]
-
+    @property
+    def train_items(self):
+        # per-user lists of the training items, only built on first use; the sampler and the
+        # evaluation read the CSR arrays of R directly
+        if not hasattr(self, '_train_items'):
+            self._train_items = {}
+            for uid in self.exist_users:
+                self._train_items[uid] = self.R.indices[self.R.indptr[uid]: self.R.indptr[uid + 1]].tolist()
+        return self._train_items
+
+    @property
+    def coo_R(self):
+        if not hasattr(self, '_coo_R'):
+            self._coo_R = self.R.tocoo()
+        return self._coo_R
+
+    def _load_text(self, train_file, test_file, img_feat_file, text_feat_file, title_enable, d1, d2):
+        train_users, train_indptr, train_indices = parse_interactions(train_file, self.n_workers)
+        test_users, test_indptr, test_indices = parse_interactions(test_file, self.n_workers)
+
+        # test lines without any item are skipped
+        test_lens = np.diff(test_indptr)
+        test_users = test_users[test_lens > 0]
+        test_indptr = np.zeros(len(test_users) + 1, dtype=np.int32)
+        test_indptr[1:] = np.cumsum(test_lens[test_lens > 0])
+
+        self.n_users = int(train_users.max()) + 1
+        self.n_items = int(max(train_indices.max(), test_indices.max())) + 1
+        self.n_train, self.n_test = len(train_indices), len(test_indices)
+
+        rows = np.repeat(train_users, np.diff(train_indptr))
+        R = sp.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, train_indices)),
+                          shape=(self.n_users, self.n_items))
+        R.sum_duplicates()
+
+        arrays = {'exist_users': train_users,
+                  'train_indptr': R.indptr.astype(np.int32), 'train_indices': R.indices.astype(np.int32),
+                  'test_users': test_users, 'test_indptr': test_indptr, 'test_indices': test_indices}
+        self._build_from_arrays(arrays)
+
+        # feature stores are float32 arrays memory-mapped from the cache, items without
+        # a feature line keep an all-zero row and are flagged False in the mask
+        self.imageFeaMatrix, self.imageFeaMask = self._compile_features(img_feat_file, 'img_feat', d1)
         if title_enable:
-            self.text_features = {}
-            with open(text_feat_file, 'r') as file:
-                for line in file.readlines():
-                    l = line.strip().split(' ')
-                    item_id = l[0]
-                    text_feat = list(map(float, l[1:]))
-                    self.text_features[int(item_id)] = text_feat
-                self.textFeatMatrix = [[0.] * d2] * self.n_items
-                for item in self.text_features:
-                    self.textFeatMatrix[item] = self.text_features[item]
-
-        self.R = self.R.tocsr()
-
-        self.coo_R = self.R.tocoo()
+            self.textFeatMatrix, self.textFeatMask = self._compile_features(text_feat_file, 'text_feat', d2)
+        return arrays
+
+    def _build_from_arrays(self, arrays):
+        self.exist_users = arrays['exist_users'].tolist()
+        self.R = sp.csr_matrix((np.ones(len(arrays['train_indices']), dtype=np.float32),
+                                arrays['train_indices'], arrays['train_indptr']),
+                               shape=(self.n_users, self.n_items))
+
+        self.test_set = {}
+        test_indptr, test_indices = arrays['test_indptr'], arrays['test_indices']
+        for k, uid in enumerate(arrays['test_users'].tolist()):
+            self.test_set[uid] = test_indices[test_indptr[k]: test_indptr[k + 1]].tolist()
+
+    def _compile_features(self, feat_file, name, d):
+        feat = np.lib.format.open_memmap(self.cache_path + '/' + name + '.npy', mode='w+',
+                                         dtype=np.float32, shape=(self.n_items, d))
+        mask = np.zeros(self.n_items, dtype=bool)
+        with open(feat_file, 'r') as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                item_id, values = line.split(' ', 1)
+                item_id = int(item_id)
+                feat[item_id] = np.fromstring(values, dtype=np.float32, sep=' ')
+                mask[item_id] = True
+        feat.flush()
+        del feat
+        np.save(self.cache_path + '/' + name + '_mask.npy', mask)
+        return self._open_features(name)
+
+    def _open_features(self, name):
+        feat = np.load(self.cache_path + '/' + name + '.npy', mmap_mode='r')
+        mask = np.load(self.cache_path + '/' + name + '_mask.npy')
+        return feat, mask
+
+    def _source_stats(self, sources, manifest=None):
+        stats = {}
+        for name, file in sources.items():
+            st = os.stat(file)
+            stats[name] = {'size': st.st_size, 'mtime': st.st_mtime}
+            old = manifest['sources'].get(name) if manifest is not None else None
+            if old is not None and old['size'] == st.st_size and old['mtime'] == st.st_mtime:
+                stats[name]['md5'] = old['md5']
+            else:
+                stats[name]['md5'] = file_md5(file)
+        return stats
+
+    def _load_cache(self, sources):
+        manifest_file = self.cache_path + '/manifest.json'
+        if not os.path.exists(manifest_file):
+            return False
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get('version') != CACHE_VERSION or set(manifest['sources']) != set(sources):
+            return False
+
+        stats = self._source_stats(sources, manifest)
+        for name in sources:
+            if stats[name]['md5'] != manifest['sources'][name]['md5']:
+                print('source file changed, rebuilding dataset cache:', sources[name])
+                return False
+        if stats != manifest['sources']:
+            # touched but unchanged content, only refresh the recorded mtimes
+            manifest['sources'] = stats
+            with open(manifest_file, 'w') as f:
+                json.dump(manifest, f, indent=2)
+
+        self.n_users, self.n_items = manifest['n_users'], manifest['n_items']
+        self.n_train, self.n_test = manifest['n_train'], manifest['n_test']
+
+        self._build_from_arrays(self._load_arrays())
+
+        self.imageFeaMatrix, self.imageFeaMask = self._open_features('img_feat')
+        if 'text_feat' in sources:
+            self.textFeatMatrix, self.textFeatMask = self._open_features('text_feat')
+        return True
+
+    def _load_arrays(self):
+        arrays = {}
+        for name in ['exist_users', 'train_indptr', 'train_indices', 'test_users', 'test_indptr', 'test_indices']:
+            arrays[name] = np.load(self.cache_path + '/' + name + '.npy')
+        return arrays
+
+    def _save_cache(self, sources, arrays):
+        for name, array in arrays.items():
+            np.save(self.cache_path + '/' + name + '.npy', array)
+
+        # the manifest is written last so an interrupted build is never picked up
+        manifest = {'version': CACHE_VERSION,
+                    'n_users': self.n_users, 'n_items': self.n_items,
+                    'n_train': self.n_train, 'n_test': self.n_test,
+                    'sources': self._source_stats(sources)}
+        with open(self.cache_path + '/manifest.json', 'w') as f:
+            json.dump(manifest, f, indent=2)
 
     def get_adj_mat(self):
-        origin_file = self.path
-
-        try:
+        # the [[I, R], [R^T, I]] graph is fully described by R, propagation only needs R and
+        # the degree vector (self-loops included); normalization is left to the model
+        t1 = time.time()
+        degree = np.concatenate([np.diff(self.R.indptr), np.bincount(self.R.indices, minlength=self.n_items)]) + 1
+
+        print('already load adj_t matrix', self.R.shape, time.time() - t1)
+        return self.R, degree.astype(np.float32)
+
+    def reduced_features(self, name, method, dim, seed=2024, chunk_size=4096):
+        # offline reduction of a feature store to dim columns, either onto its top principal axes
+        # ('pca') or onto a random orthonormal basis ('random'); stored as a new feature store
+        # <name>_<method><dim> (plus _s<seed> for random bases) with a json recording the retained
+        # share of the centered variance
+        reduced = '%s_%s%d' % (name, method, dim)
+        if method == 'random':
+            reduced += '_s%d' % seed
+        info_file = self.cache_path + '/' + reduced + '.json'
+        if not os.path.exists(info_file):
             t1 = time.time()
-            if not os.path.exists(origin_file):
-                os.mkdir(origin_file)
-
-            left = sp.load_npz(origin_file + '/adj_mat_left.npz')
-            norm_adj_mat_3 = sp.load_npz(origin_file + '/adj_mat_3.npz')
-            norm_adj_mat_4 = sp.load_npz(origin_file + '/adj_mat_4.npz')
-            norm_adj_mat_5 = sp.load_npz(origin_file + '/adj_mat_5.npz')
-
-            print('already load adj_t matrix', norm_adj_mat_4.shape, time.time() - t1)
-
-        except Exception:
-            left, norm_adj_mat_3, norm_adj_mat_4, norm_adj_mat_5 = self.create_adj_mat()
-
-            sp.save_npz(origin_file + '/adj_mat_left.npz', left)
-            sp.save_npz(origin_file + '/adj_mat_3.npz', norm_adj_mat_3)
-            sp.save_npz(origin_file + '/adj_mat_4.npz', norm_adj_mat_4)
-            sp.save_npz(origin_file + '/adj_mat_5.npz', norm_adj_mat_5)
-
-        return left, norm_adj_mat_3, norm_adj_mat_4, norm_adj_mat_5
-
-    def create_adj_mat(self):
+            feat, mask = self._open_features(name)
+            n, d = feat.shape
+            if dim >= d:
+                raise ValueError('cannot reduce %d-d features to %d dimensions' % (d, dim))
+
+            # second moments in float64, one pass over the memmap
+            total = np.zeros(d)
+            cov = np.zeros((d, d))
+            for start in range(0, n, chunk_size):
+                block = np.asarray(feat[start: start + chunk_size], dtype=np.float64)
+                total += block.sum(axis=0)
+                cov += np.dot(block.T, block)
+            mean = total / n
+            cov = cov / n - np.outer(mean, mean)
+
+            if method == 'pca':
+                s, u = np.linalg.eigh(cov)
+                proj = u[:, ::-1][:, :dim]
+            elif method == 'random':
+                proj, _ = np.linalg.qr(np.random.RandomState(seed).randn(d, dim))
+            else:
+                raise ValueError('unknown reduction method: %s' % method)
+            retained = float(np.trace(np.dot(proj.T, np.dot(cov, proj))) / np.trace(cov))
+
+            # projected without centering, items without features stay all zero
+            proj = proj.astype(np.float32)
+            out = np.lib.format.open_memmap(self.cache_path + '/' + reduced + '.npy', mode='w+',
+                                            dtype=np.float32, shape=(n, dim))
+            for start in range(0, n, chunk_size):
+                out[start: start + chunk_size] = np.dot(feat[start: start + chunk_size], proj)
+            out.flush()
+            del out
+            np.save(self.cache_path + '/' + reduced + '_mask.npy', mask)
+            np.save(self.cache_path + '/' + reduced + '_proj.npy', proj)
+
+            # written last, an interrupted reduction is redone
+            info = {'name': reduced, 'source': name, 'method': method, 'dim': dim, 'source_dim': d,
+                    'seed': seed, 'retained_variance': retained}
+            with open(info_file, 'w') as f:
+                json.dump(info, f, indent=2)
+            print('already reduce features', name, method, dim, 'retained variance', retained, time.time() - t1)
+
+        with open(info_file) as f:
+            info = json.load(f)
+        return self._open_features(reduced)[0], info
+
+    def create_bipartite_adj(self):
+        # binary [[I, R], [R^T, I]] adjacency written straight into CSR arrays with sorted
+        # column indices, plus its degree vector (self-loops included)
+        n = self.n_users + self.n_items
+        R = self.R
+        RT = self.R.transpose().tocsr()
+        RT.sort_indices()
+        deg_u, deg_i = np.diff(R.indptr), np.diff(RT.indptr)
+        nnz = R.nnz
+
+        degree = np.concatenate([deg_u, deg_i]) + 1
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(degree)
+        indices = np.empty(indptr[-1], dtype=np.int32)
+
+        # user rows: self-loop first, then the items shifted by n_users
+        users = np.arange(self.n_users)
+        indices[R.indptr[:-1] + users] = users
+        indices[np.arange(nnz) + np.repeat(users, deg_u) + 1] = R.indices + self.n_users
+
+        # item rows: the users, then the self-loop last
+        items = np.arange(self.n_items)
+        offset = nnz + self.n_users
+        indices[offset + np.arange(nnz) + np.repeat(items, deg_i)] = RT.indices
+        indices[offset + RT.indptr[1:] + items] = items + self.n_users
+
+        if indptr[-1] < np.iinfo(np.int32).max:
+            indptr = indptr.astype(np.int32)
+        adj = sp.csr_matrix((np.ones(len(indices), dtype=np.float32), indices, indptr), shape=(n, n))
+        return adj, degree.astype(np.float32)
+
+    def create_adj_mat(self, exponents=((-1.0, -0.0), (-0.5, -0.3), (-0.5, -0.4), (-0.5, -0.5))):
             t1 = time.time()
-            adj_mat = sp.dok_matrix((self.n_users + self.n_items, self.n_users + self.n_items), dtype=np.float32)
-            adj_mat = adj_mat.tolil()
-    
-            R = self.R.tolil()
+            adj_mat, degree = self.create_bipartite_adj()
+            print('already create adjacency matrix', adj_mat.shape, time.time() - t1)
 
-            adj_mat[:self.n_users, self.n_users: self.n_users + self.n_items] = R
-            adj_mat[self.n_users: self.n_users + self.n_items, :self.n_users] = R.T
+            t2 = time.time()
+            rows = np.repeat(np.arange(adj_mat.shape[0], dtype=np.int32), np.diff(adj_mat.indptr))
+            degree = degree.astype(np.float64)
 
-            adj_mat = adj_mat.todok()
+            def normalized_adj_symetric(d1, d2):
+                # D^d1 (A + I) D^d2, every variant shares the index arrays of adj_mat
+                values = np.power(degree, d1)[rows]
+                values *= np.power(degree, d2)[adj_mat.indices]
+                return sp.csr_matrix((values.astype(np.float32), adj_mat.indices, adj_mat.indptr),
+                                     shape=adj_mat.shape)
 
-            print('already create adjacency matrix', adj_mat.shape, time.time() - t1)
-    
-            t2 = time.time()
-    
-            def normalized_adj_symetric(adj, d1, d2):
-                adj = sp.coo_matrix(adj)
-                rowsum = np.array(adj.sum(1))
-                d_inv_sqrt = np.power(rowsum, d1).flatten()
-                d_inv_sqrt[np.isinf(d_inv_sqrt)] = 0.
-                d_mat_inv_sqrt = sp.diags(d_inv_sqrt)
-    
-                d_inv_sqrt_last = np.power(rowsum, d2).flatten()
-                d_inv_sqrt_last[np.isinf(d_inv_sqrt_last)] = 0.
-                d_mat_inv_sqrt_last = sp.diags(d_inv_sqrt_last)
-    
-                return adj.dot(d_mat_inv_sqrt).transpose().dot(d_mat_inv_sqrt_last).tocoo()
-
-            norm_adj_mat_left = normalized_adj_symetric(adj_mat + sp.eye(adj_mat.shape[0]), - 1.0, -0.0)
-            norm_adj_mat_53 = normalized_adj_symetric(adj_mat + sp.eye(adj_mat.shape[0]), - 0.5, -0.3)
-            norm_adj_mat_54 = normalized_adj_symetric(adj_mat + sp.eye(adj_mat.shape[0]), - 0.5, -0.4)
-            norm_adj_mat_55 = normalized_adj_symetric(adj_mat + sp.eye(adj_mat.shape[0]), - 0.5, -0.5)
-
-            norm_adj_mat_left = norm_adj_mat_left.tocsr()
-            norm_adj_mat_53 = norm_adj_mat_53.tocsr()
-            norm_adj_mat_54 = norm_adj_mat_54.tocsr()
-            norm_adj_mat_55 = norm_adj_mat_55.tocsr()
+            norm_adj_mats = [normalized_adj_symetric(d1, d2) for d1, d2 in exponents]
 
             print('already normalize adjacency matrix', time.time() - t2)
-            return norm_adj_mat_left.tocsr(), norm_adj_mat_53.tocsr(), norm_adj_mat_54.tocsr(), norm_adj_mat_55.tocsr()
-
-    def sample_u(self):
-        total_users = self.exist_users 
-        users = rd.sample(total_users, self.batch_size)
-
-        def sample_pos_items_for_u(u):
-            pos_items = self.train_items[u]
-            n_pos_items = len(pos_items)
-            pos_id = np.random.randint(low=0, high=n_pos_items, size=1)[0]
-            pos_i_id = pos_items[pos_id]
-            return pos_i_id
-
-        def sample_neg_items_for_u(u):
-            pos_items = self.train_items[u]
-            while True:
-                neg_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-                if neg_id not in pos_items:
-                    return neg_id
-
-        pos_items, neg_items, pos_users_for_pi, neg_users_for_pi = [], [], [], []
-        for u in users:
-            pos_i = sample_pos_items_for_u(u)
-            neg_i = sample_neg_items_for_u(u)
-
-            pos_items.append(pos_i)
-            neg_items.append(neg_i)
-
-        return users, pos_items, neg_items
+            return norm_adj_mats
+
+    def sample_epoch(self, n_batch, rng=None):
+        # vectorized BPR sampling of n_batch batches at once, returns (users, pos_items, neg_items)
+        # int32 arrays of shape (n_batch, batch_size); users are distinct within a batch
+        rng = np.random if rng is None else rng
+        exist_users = np.asarray(self.exist_users, dtype=np.int64)
+        n_exist = len(exist_users)
+        if self.batch_size > n_exist:
+            raise ValueError('batch_size %d is larger than the %d training users' % (self.batch_size, n_exist))
+
+        idx = rng.randint(0, n_exist, size=(n_batch, self.batch_size))
+        rows = np.arange(n_batch)[:, None]
+        while True:
+            order = np.argsort(idx, axis=1)
+            dup = np.zeros(idx.shape, dtype=bool)
+            dup[:, 1:] = idx[rows, order[:, 1:]] == idx[rows, order[:, :-1]]
+            if not dup.any():
+                break
+            dup_rows, dup_cols = np.nonzero(dup)
+            idx[dup_rows, order[dup_rows, dup_cols]] = rng.randint(0, n_exist, size=len(dup_rows))
+        users = exist_users[idx]
+
+        # positives: a uniform position inside each user's CSR row
+        start = self.R.indptr[users]
+        n_pos = self.R.indptr[users + 1] - start
+        pos_items = self.R.indices[start + (rng.random_sample(users.shape) * n_pos).astype(np.int64)]
+
+        # negatives: rejection against the sorted (user, item) keys of R
+        train_keys = self._train_keys()
+        keys = users * self.n_items
+        neg_items = rng.randint(0, self.n_items, size=users.shape)
+        redraw = np.ones(users.shape, dtype=bool)
+        while True:
+            hit = _sorted_member(train_keys, keys[redraw] + neg_items[redraw])
+            if not hit.any():
+                break
+            redraw[redraw] = hit
+            neg_items[redraw] = rng.randint(0, self.n_items, size=int(hit.sum()))
+
+        return users.astype(np.int32), pos_items.astype(np.int32), neg_items.astype(np.int32)
+
+    def _train_keys(self):
+        # row * n_items + col of every training interaction, sorted because R has sorted indices
+        if not hasattr(self, '_train_keys_cache'):
+            rows = np.repeat(np.arange(self.n_users, dtype=np.int64), np.diff(self.R.indptr))
+            self._train_keys_cache = rows * self.n_items + self.R.indices
+        return self._train_keys_cache
+
+    def sample_u(self, rng=None):
+        users, pos_items, neg_items = self.sample_epoch(1, rng)
+        return users[0], pos_items[0], neg_items[0]
+
+    def eval_candidates(self, users, n_neg=99, seed=2024):
+        # evaluation candidates of each user: n_neg fixed negatives followed by the test positives
+        negatives = self._eval_negatives(n_neg, seed)
+        return [negatives[self._test_rows[u]].tolist() + self.test_set[u] for u in users]
+
+    def _eval_negatives(self, n_neg, seed):
+        # negatives are drawn once per dataset and kept in the cache, so every evaluation
+        # and every run ranks against the same candidates
+        if getattr(self, '_eval_neg_key', None) == (n_neg, seed):
+            return self._eval_neg
+        test_users = np.asarray(list(self.test_set.keys()), dtype=np.int64)
+        self._test_rows = dict(zip(test_users.tolist(), range(len(test_users))))
+
+        neg_file = self.cache_path + '/eval_neg_%d_%d.npy' % (n_neg, seed)
+        if os.path.exists(neg_file):
+            self._eval_neg = np.load(neg_file)
+        else:
+            t1 = time.time()
+            self._eval_neg = self._sample_eval_negatives(test_users, n_neg, np.random.RandomState(seed))
+            np.save(neg_file + '.tmp.npy', self._eval_neg)
+            os.rename(neg_file + '.tmp.npy', neg_file)
+            print('already sample evaluation negatives', self._eval_neg.shape, time.time() - t1)
+        self._eval_neg_key = (n_neg, seed)
+        return self._eval_neg
+
+    def _sample_eval_negatives(self, users, n_neg, rng):
+        # vectorized sampling without replacement of items outside each user's train and test sets
+        test_lens = np.array([len(self.test_set[u]) for u in users.tolist()], dtype=np.int64)
+        n_free = self.n_items - np.diff(self.R.indptr)[users] - test_lens
+        if len(users) and n_free.min() < n_neg:
+            raise ValueError('user %d has fewer than %d unseen items' % (users[n_free.argmin()], n_neg))
+
+        test_items = np.array([i for u in users.tolist() for i in self.test_set[u]], dtype=np.int64)
+        seen_keys = np.sort(np.concatenate([self._train_keys(), np.repeat(users, test_lens) * self.n_items + test_items]))
+
+        keys = users * self.n_items
+        neg_items = rng.randint(0, self.n_items, size=(len(users), n_neg))
+        # after the first round only the rows with redrawn entries are checked again, and only
+        # their redrawn entries against the seen keys
+        active = np.arange(len(users))
+        changed = np.ones(neg_items.shape, dtype=bool)
+        while True:
+            items = neg_items[active]
+            # rows sorted once serve both checks: the seen-key lookup runs on ascending queries
+            # within each row, and repeated items within a row keep their first occurrence
+            rows = np.arange(len(active))[:, None]
+            order = np.argsort(items, axis=1, kind='mergesort')
+            sorted_items = items[rows, order]
+            sorted_changed = changed[rows, order]
+            query = (keys[active][:, None] + sorted_items)[sorted_changed]
+            found = np.minimum(np.searchsorted(seen_keys, query), len(seen_keys) - 1)
+            sorted_redraw = np.zeros(items.shape, dtype=bool)
+            sorted_redraw[sorted_changed] = seen_keys[found] == query
+            sorted_redraw[:, 1:] |= sorted_items[:, 1:] == sorted_items[:, :-1]
+            redraw = np.empty(items.shape, dtype=bool)
+            redraw[rows, order] = sorted_redraw
+            if not redraw.any():
+                break
+            items[redraw] = rng.randint(0, self.n_items, size=int(redraw.sum()))
+            neg_items[active] = items
+            keep = redraw.any(axis=1)
+            active, changed = active[keep], redraw[keep]
+
+        return neg_items.astype(np.int32)
 
     def print_statistics(self):
         print('n_users=%d, n_items=%d' % (self.n_users, self.n_items))
@@ -3,11 +3,16 @@ import tensorflow as tf
 import os
 import sys
 from load_data import Data
+from sampler import PrefetchSampler
+from metrics import pad_candidates, full_ranking_metrics, MetricsPool
 import numpy as np
-import math
 import multiprocessing
-import heapq
+import collections
+import json
 import random as rd
+import argparse
+from checkpoint import Checkpointer
+from telemetry import Telemetry, StageTimer
 
 # from sklearn.linear_modal import LogisticRegression
 def seed_everything(seed):
@@ -32,79 +37,120 @@ Hyper-parameter settings.
 n_layers = 5
 decay = 0.001
 interval = 5
+save_interval = 1
 lambda_v, lambda_t, lambda_m = 0.6, 0.3, 1.0
 mju_mf_v, mju_mf_t, mju_mf_m = 1.2, 1.0, 1.9
 mju_emb_v, mju_emb_t, mju_emb_m = 1.1, 0.4, 1.0
 eit_dfd, eit_cfd = 0.08, 1.0
 
+stale_steps = 0  # > 0 caches the whitened item projections, refreshed every stale_steps steps
+img_reduce = None  # ('pca', dim) or ('random', dim) trains on reduced visual features
+full_ranking = False
+item_chunk = 65536
+
 lr = 0.001
-batch_size = 2048
+# overridable so small (e.g. synthetic benchmark) datasets can train with fewer users than a batch
+batch_size = int(os.environ.get('CFDTBD_BATCH_SIZE', 2048))
 embed_size = 64
 epoch = 500
+t_data = time.time()
 data_generator = Data(path=data_path + dataset, batch_size=batch_size)
+data_load_time = time.time() - t_data
 USR_NUM, ITEM_NUM = data_generator.n_users, data_generator.n_items
 N_TRAIN, N_TEST = data_generator.n_train, data_generator.n_test
 BATCH_SIZE = batch_size
 Ks = np.arange(1, 21)
 
 # model test module
-def test_one_user(x):
-    seed_everything(2024)
-    u, rating = x[1], x[0]
-
-    training_items = data_generator.train_items[u]
-
-    user_pos_test = data_generator.test_set[u]
-
-    all_items = set(range(ITEM_NUM))
-
-    test_items = rd.sample(list(all_items - set(training_items) - set(user_pos_test)), 99) + user_pos_test
-
-    item_score = {}
-    for i in test_items:
-        item_score[i] = rating[i]
-
-    K_max = max(Ks)
-    K_max_item_score = heapq.nlargest(K_max, item_score, key=item_score.get)
-
-    r = []
-    for i in K_max_item_score:
-        if i in user_pos_test:
-            r.append(1)
-        else:
-            r.append(0)
-
-    precision, recall, ndcg, hit_ratio = [], [], [], []
-
-    def hit_at_k(r, k):
-        r = np.array(r)[:k]
-        if np.sum(r) > 0:
-            return 1.
-        else:
-            return 0.
-
-    def ndcg_at_k(r, k):
-        r = np.array(r)[:k]
+def rate_candidates(embeddings, users, candidates, block_size=256):
+    # per-user dot products with the candidate rows only, over user blocks so the gathered
+    # (block, n_cand, d) item slab stays small; padded (-1) candidates score -inf
+    ua, ia = embeddings
+    users = np.asarray(users)
+    rating = np.empty(candidates.shape, dtype=np.float32)
+    for start in range(0, len(users), block_size):
+        end = start + block_size
+        rating[start: end] = np.einsum('ud,ucd->uc', ua[users[start: end]],
+                                       ia[np.maximum(candidates[start: end], 0)])
+    rating[candidates < 0] = -np.inf
+    return rating
+
+
+def rate_items(embeddings, users, start, end):
+    ua, ia = embeddings
+    return np.dot(ua[users], ia[start: end].T)
+
+
+def export_embeddings(sess, model, path):
+    # fused user/item matrices, a rating is np.dot(user_embeddings[u], item_embeddings[i])
+    if not os.path.exists(path):
+        os.makedirs(path)
+    ua, ia = sess.run(model.eval_embeddings, model.eval_feed)
+    np.save(path + '/user_embeddings.npy', ua)
+    np.save(path + '/item_embeddings.npy', ia)
+    print('already export embeddings', ua.shape, ia.shape)
+
+
+def export_model(sess, model, path):
+    # everything inference.InferenceModel needs to rebuild the embeddings without TF
+    if not os.path.exists(path):
+        os.makedirs(path)
+    weights = sess.run(model.weights)
+    zca = sess.run(model.zca_matrices)
+    for name, matrices in zca.items():
+        for k, matrix in enumerate(matrices):
+            weights['zca_%s_%d' % (name, k)] = matrix
+    np.savez(path + '/weights.npz', R_indptr=model.R.indptr, R_indices=model.R.indices,
+             degree=model.degree, **weights)
+
+    config = {'n_users': model.n_users, 'n_items': model.n_items, 'n_layers': model.n_layers,
+              'adj_exp': model.adj_exp, 'adj_exp_com': model.adj_exp_com,
+              'adj_exp_dif': model.adj_exp_dif, 'adj_exp_m': model.adj_exp_m,
+              'lambda_v': lambda_v, 'lambda_t': lambda_t, 'lambda_m': lambda_m,
+              'whitened': sorted(zca), 'zca_batch_size': data_generator.n_items,
+              'img_feat': model.img_feat_file or os.path.abspath(data_generator.cache_path + '/img_feat.npy'),
+              'img_reduce': model.img_reduce,
+              'text_feat': os.path.abspath(data_generator.cache_path + '/text_feat.npy')}
+    with open(path + '/config.json', 'w') as f:
+        json.dump(config, f, indent=2)
+    print('already export model', path)
+
+
+def test_full(sess, model, users, batch_size, item_chunk):
+    # ranks every item of the catalog, training interactions excluded
+    result = {'ndcg': np.zeros(len(Ks)),
+              'hit_ratio': np.zeros(len(Ks)),
+              'precision': np.zeros(len(Ks)),
+              'recall': np.zeros(len(Ks)),
+              'mrr': np.zeros(len(Ks))}
 
-        if np.sum(r) > 0:
-            return math.log(2) / math.log(np.where(r == 1)[0] + 2)
-        else:
-            return 0.
+    embeddings = sess.run(model.eval_embeddings, model.eval_feed)
 
-    for K in Ks:
-        ndcg.append(ndcg_at_k(r, K))
-        hit_ratio.append(hit_at_k(r, K))
+    def rate_fn(user_batch, start, end):
+        return rate_items(embeddings, user_batch, start, end)
 
-    return {'ndcg': np.array(ndcg), 'hit_ratio': np.array(hit_ratio), 'k': (u, K_max_item_score[:20])}
+    u_batch_size = batch_size * 2
+    for start in range(0, len(users), u_batch_size):
+        user_batch = users[start: start + u_batch_size]
+        batch_result, _ = full_ranking_metrics(rate_fn, user_batch, data_generator.R, data_generator.test_set,
+                                               Ks, item_chunk)
+        for name in result:
+            result[name] += batch_result[name].sum(axis=0) / len(users)
+    return result
 
 
-def test(sess, model, users, items, batch_size, cores):
-    seed_everything(2024)
+def test(sess, model, users, items, batch_size, pool, timer=None):
+    timer = StageTimer() if timer is None else timer
     result = {'ndcg': np.zeros(len(Ks)),
               'hit_ratio': np.zeros(len(Ks)),
+              'precision': np.zeros(len(Ks)),
+              'recall': np.zeros(len(Ks)),
+              'mrr': np.zeros(len(Ks)),
               'k': []}
 
-    pool = multiprocessing.Pool(cores)
+    # propagate every tower once per evaluation, user batches then only score their candidates
+    with timer('propagate'):
+        embeddings = sess.run(model.eval_embeddings, model.eval_feed)
 
     u_batch_size = batch_size * 2
 
@@ -120,69 +166,113 @@ def test(sess, model, users, items, batch_size, cores):
         end = (u_batch_id + 1) * u_batch_size
 
         user_batch = users[start: end]
+        if len(user_batch) == 0:
+            continue
 
-        item_batch = items
+        with timer('candidates'):
+            candidate_batch = pad_candidates(data_generator.eval_candidates(user_batch))
 
-        rate_batch = sess.run(model.batch_ratings, {model.users: user_batch,
-                                                    model.pos_items: item_batch})
+        with timer('scoring'):
+            rate_batch = rate_candidates(embeddings, user_batch, candidate_batch)
 
-        user_batch_rating_uid = zip(rate_batch, user_batch)
+        with timer('metrics'):
+            user_pos_test = [data_generator.test_set[u] for u in user_batch]
+            pos_keys = np.repeat(user_batch, [len(p) for p in user_pos_test]) * ITEM_NUM + np.concatenate(user_pos_test)
+            relevance = np.isin(np.asarray(user_batch)[:, None] * ITEM_NUM + candidate_batch, pos_keys) & (candidate_batch >= 0)
 
-        batch_result = pool.map(test_one_user, user_batch_rating_uid)
+            batch_result, top = pool.run(rate_batch, relevance)
 
-        count += len(batch_result)
+        count += len(user_batch)
 
-        for re in batch_result:
-            result['ndcg'] += re['ndcg'] / n_test_users
-            result['hit_ratio'] += re['hit_ratio'] / n_test_users
-            result['k'].append(re['k'])
+        for name in ['ndcg', 'hit_ratio', 'precision', 'recall', 'mrr']:
+            result[name] += batch_result[name].sum(axis=0) / n_test_users
+        top_items = candidate_batch[np.arange(len(user_batch))[:, None], top[:, :20]]
+        result['k'].extend(zip(user_batch, top_items.tolist()))
 
     assert count == n_test_users
-    pool.close()
     return result
 
 
+def create_input_pipeline(sampler):
+    # training batches are pulled from the prefetching sampler by tf.data instead of feed_dict
+    dataset = tf.data.Dataset.from_generator(sampler.__iter__, (tf.int32, tf.int32, tf.int32),
+                                             (tf.TensorShape([None]), tf.TensorShape([None]), tf.TensorShape([None])))
+    return dataset.make_one_shot_iterator().get_next()
+
+
 class Model(object):
-    def __init__(self, data_config, img_feat, text_feat, d1, d2):
+    def __init__(self, data_config, img_feat, text_feat, d1, d2, batch=None):
         self.n_users = data_config['n_users']
         self.n_items = data_config['n_items']
         self.d1 = d1
+        # where the d1-wide visual features come from, recorded by export_model
+        self.img_feat_file = data_config.get('img_feat_file')
+        self.img_reduce = data_config.get('img_reduce')
         self.d2 = d2
-        self.n_fold = 10
-        self.norm_adj = data_config['norm_adj']
-        self.norm_adj_com = data_config['norm_adj_com']
-        self.norm_adj_dif = data_config['norm_adj_dif']
-        self.norm_adj_m = data_config['norm_adj_m']
-        self.n_nonzero_elems = self.norm_adj.count_nonzero()
+        # only the binary user-item block R is kept, the [[I, R], [R^T, I]] propagation is done
+        # per side with R and its adjoint and each call applies its own D^d1 (A + I) D^d2 scaling
+        self.R = data_config['R']
+        self.degree = data_config['degree']
+        self.degree_u = tf.constant(self.degree[:self.n_users], dtype=tf.float32)
+        self.degree_i = tf.constant(self.degree[self.n_users:], dtype=tf.float32)
+        self.adj_exp = data_config['adj_exp']
+        self.adj_exp_com = data_config['adj_exp_com']
+        self.adj_exp_dif = data_config['adj_exp_dif']
+        self.adj_exp_m = data_config['adj_exp_m']
+        self.n_nonzero_elems = self.R.nnz
+        self.sp_cache_dir = data_config.get('sp_cache_dir')
         self.lr = data_config['lr']
         self.emb_dim = data_config['embed_size']
         self.batch_size = data_config['batch_size']
         self.n_layers = data_config['n_layers']
         self.decay = data_config['decay']
 
-        self.users = tf.placeholder(tf.int32, shape=(None,))
-        self.pos_items = tf.placeholder(tf.int32, shape=(None,))
-        self.neg_items = tf.placeholder(tf.int32, shape=(None,))
+        if batch is None:
+            self.users = tf.placeholder(tf.int32, shape=(None,))
+            self.pos_items = tf.placeholder(tf.int32, shape=(None,))
+            self.neg_items = tf.placeholder(tf.int32, shape=(None,))
+        else:
+            # (users, pos_items, neg_items) from the input pipeline, feeding still overrides them
+            self.users = tf.placeholder_with_default(batch[0], shape=(None,))
+            self.pos_items = tf.placeholder_with_default(batch[1], shape=(None,))
+            self.neg_items = tf.placeholder_with_default(batch[2], shape=(None,))
 
         self.weights = self._init_weights()
 
+        # large arrays (raw features, sparse structure) are fed through init_feed when the
+        # local variables are initialized
+        self.init_feed = {}
+        self._sp_tensors = {}
+        self.R_hat = self._sp_tensor(self.R, 'R')
+
+        img_feat = self._local_constant(img_feat, tf.float32, 'img_feat')
+        text_feat = self._local_constant(text_feat, tf.float32, 'text_feat')
+
         '''
         ######################################################################################
         multimodal information processing
         '''
         # Whitening Transformation Module
+        self.zca_matrices = {}
         t = time.time()
         print('Whitening of pre-trained visual modality features')
-        self.im_v1_pre = tf.matmul(img_feat, self.weights['w1_v'])
-        self.im_v1 = self.zca_whitening(self.im_v1_pre)
+        self.im_v1_pre, self.im_v2_pre = self._dual_projection(img_feat, 'w1_v', 'w2_v')
+        self.im_v1 = self.zca_whitening(self.im_v1_pre, name='v1')
 
-        self.im_v2_pre = tf.matmul(img_feat, self.weights['w2_v'])
-        self.im_v2 = self.zca_whitening(self.im_v2_pre)
+        self.im_v2 = self.zca_whitening(self.im_v2_pre, name='v2')
         print('Already whitening', time.time() - t)
 
-        self.im_t1 = tf.matmul(text_feat, self.weights['w1_t'])
-        self.im_t2 = tf.matmul(text_feat, self.weights['w2_t'])
+        self.im_t1, self.im_t2 = self._dual_projection(text_feat, 'w1_t', 'w2_t')
+
 
+        # stale mode: the towers read cached projections and whitening matrices, refreshed by
+        # refresh_projections, and only the rows of the current batch are projected per step
+        self.stale_steps = data_config.get('stale_steps', 0)
+        self.eval_feed = {}
+        if self.stale_steps:
+            self.im_v1, self.im_t1, self.im_v2, self.im_t2 = self._stale_projections(
+                [('v1', img_feat, 'w1_v', self.im_v1), ('t1', text_feat, 'w1_t', self.im_t1),
+                 ('v2', img_feat, 'w2_v', self.im_v2), ('t2', text_feat, 'w2_t', self.im_t2)])
 
         self.um_v1 = self.weights['user_embedding_v1']
         self.um_t1 = self.weights['user_embedding_t1']
@@ -207,9 +297,16 @@ class Model(object):
         ######################################################################################
         generate multimodal-dimension embeddings
         '''
+        # towers sharing a normalization are propagated together as one wide SpMM
+        [(self.ua_embeddings_v1, self.ia_embeddings_v1), (self.ua_embeddings_t1, self.ia_embeddings_t1),
+         (self.ua_embeddings_v2, self.ia_embeddings_v2), (self.ua_embeddings_t2, self.ia_embeddings_t2)] = \
+            self._propagate_towers([(self.um_v1, self.im_v1, self.adj_exp_com, 1),
+                                    (self.um_t1, self.im_t1, self.adj_exp_com, 1),
+                                    (self.um_v2, self.im_v2, self.adj_exp_dif, 1),
+                                    (self.um_t2, self.im_t2, self.adj_exp_dif, 1)])
+
         # common feature learning for item visual content
         # self.um_int_v = self.ua_embeddings
-        self.ua_embeddings_v1, self.ia_embeddings_v1 = self._create_norm_embed_v1()
         self.u_g_embeddings_v1 = tf.nn.embedding_lookup(self.ua_embeddings_v1, self.users)
         self.pos_i_g_embeddings_v1 = tf.nn.embedding_lookup(self.ia_embeddings_v1, self.pos_items)
         self.neg_i_g_embeddings_v1 = tf.nn.embedding_lookup(self.ia_embeddings_v1, self.neg_items)
@@ -220,7 +317,6 @@ class Model(object):
 
         # common feature learning for item textual content
         # self.um_int_t = self.ua_embeddings
-        self.ua_embeddings_t1, self.ia_embeddings_t1 = self._create_norm_embed_t1()
         self.u_g_embeddings_t1 = tf.nn.embedding_lookup(self.ua_embeddings_t1, self.users)
         self.pos_i_g_embeddings_t1 = tf.nn.embedding_lookup(self.ia_embeddings_t1, self.pos_items)
         self.neg_i_g_embeddings_t1 = tf.nn.embedding_lookup(self.ia_embeddings_t1, self.neg_items)
@@ -234,7 +330,6 @@ class Model(object):
                         tf.reduce_mean(self.cosine_similarity(self.pos_i_g_embeddings_v1, self.pos_i_g_embeddings_t1))
 
         # differential feature learning for item visual content
-        self.ua_embeddings_v2, self.ia_embeddings_v2 = self._create_norm_embed_v2()
         self.u_g_embeddings_v2 = tf.nn.embedding_lookup(self.ua_embeddings_v2, self.users)
         self.pos_i_g_embeddings_v2 = tf.nn.embedding_lookup(self.ia_embeddings_v2, self.pos_items)
         self.neg_i_g_embeddings_v2 = tf.nn.embedding_lookup(self.ia_embeddings_v2, self.neg_items)
@@ -244,7 +339,6 @@ class Model(object):
         self.neg_i_g_embeddings_v2_pre = tf.nn.embedding_lookup(self.im_v2, self.neg_items)
 
         # differential feature learning for item textual content
-        self.ua_embeddings_t2, self.ia_embeddings_t2 = self._create_norm_embed_t2()
         self.u_g_embeddings_t2 = tf.nn.embedding_lookup(self.ua_embeddings_t2, self.users)
         self.pos_i_g_embeddings_t2 = tf.nn.embedding_lookup(self.ia_embeddings_t2, self.pos_items)
         self.neg_i_g_embeddings_t2 = tf.nn.embedding_lookup(self.ia_embeddings_t2, self.neg_items)
@@ -298,6 +392,14 @@ class Model(object):
         self.batch_ratings = self.batch_ratings_base + lambda_v*self.batch_ratings_v + lambda_t*self.batch_ratings_t + \
                              lambda_m*self.batch_ratings_m
 
+        # batch_ratings as a single inner product: the towers concatenated (64 + 128 + 128 + 256)
+        # with the lambdas folded into the user side, fetched once per evaluation by test()
+        self.ua_embeddings_fused = tf.concat([self.ua_embeddings, lambda_v*self.ua_embeddings_v,
+                                              lambda_t*self.ua_embeddings_t, lambda_m*self.ua_embeddings_m], axis=1)
+        self.ia_embeddings_fused = tf.concat([self.ia_embeddings, self.ia_embeddings_v,
+                                              self.ia_embeddings_t, self.ia_embeddings_m], axis=1)
+        self.eval_embeddings = (self.ua_embeddings_fused, self.ia_embeddings_fused)
+
         '''
         ######################################################################################
         loss function
@@ -344,10 +446,11 @@ class Model(object):
         # self.global_T = tf.Variable(initial_value=tf.ones((1,), dtype=tf.float32), trainable=True)
         return all_weights
 
-    def zca_whitening(self, X, batch_size=data_generator.n_items):
+    def zca_whitening(self, X, batch_size=data_generator.n_items, name=None):
 
         num_batches = int(np.ceil(X.shape[0].value / batch_size))
         whitened_batches = []
+        zca_matrices = []
         for i in range(num_batches):
             start = i * batch_size
             end = min((i + 1) * batch_size, X.shape[0])
@@ -362,149 +465,100 @@ class Model(object):
 
             whitened_batch = tf.matmul(X_batch, zca_matrix)
             whitened_batches.append(whitened_batch)
+            zca_matrices.append(zca_matrix)
+
+        # kept for export_model, the inference engine reuses the exact whitening matrices
+        if name is not None:
+            self.zca_matrices[name] = zca_matrices
 
         whitened = tf.concat(whitened_batches, axis=0)
         return whitened
 
-    def _split_A_hat(self, X):
-
-        A_fold_hat = []
-
-        fold_len = (self.n_users + self.n_items) // self.n_fold
-        for i_fold in range(self.n_fold):
-            start = i_fold * fold_len
-            if i_fold == self.n_fold - 1:
-                end = self.n_users + self.n_items
-            else:
-                end = (i_fold + 1) * fold_len
-
-            A_fold_hat.append(self._convert_sp_mat_to_sp_tensor(X[start:end]))
-        return A_fold_hat
+    def _propagate(self, u_embeddings, i_embeddings, exponents):
+        d1, d2 = exponents
+        u_side = u_embeddings * tf.expand_dims(tf.pow(self.degree_u, d2), 1)
+        i_side = i_embeddings * tf.expand_dims(tf.pow(self.degree_i, d2), 1)
+
+        # the identity blocks reduce to the scaled self terms
+        u_embeddings = u_side + tf.sparse_tensor_dense_matmul(self.R_hat, i_side)
+        i_embeddings = i_side + tf.sparse_tensor_dense_matmul(self.R_hat, u_side, adjoint_a=True)
+
+        return u_embeddings * tf.expand_dims(tf.pow(self.degree_u, d1), 1), \
+               i_embeddings * tf.expand_dims(tf.pow(self.degree_i, d1), 1)
+
+    def _dual_projection(self, feat, w1, w2):
+        # the common and differential projections share one pass over the raw features,
+        # the weights stay separate variables so checkpoints and exports are unchanged
+        X = tf.matmul(feat, tf.concat([self.weights[w1], self.weights[w2]], axis=1))
+        return tf.split(X, [self.emb_dim, self.emb_dim], 1)
+
+    def _stale_projections(self, towers):
+        # towers are (name, raw features, projection weight, fresh whitened projection). The cache
+        # holds the fresh projection as of the last refresh; the batch rows are recomputed from the
+        # current weight and the cached whitening matrix and overwrite theirs through scatter_nd, so
+        # the weights get gradients from those rows only and a step no longer touches the catalog
+        rows = tf.unique(tf.concat([self.pos_items, self.neg_items], axis=0))[0]
+        # evaluation reads the caches as they are instead of pulling a batch from the pipeline
+        self.eval_feed = {self.pos_items: np.zeros(0, dtype=np.int32), self.neg_items: np.zeros(0, dtype=np.int32)}
+
+        refresh = []
+        outputs = []
+        for name, feat, w, fresh in towers:
+            cache = tf.Variable(tf.zeros([self.n_items, self.emb_dim]), trainable=False,
+                                collections=[tf.GraphKeys.LOCAL_VARIABLES], name='stale_' + name)
+            refresh.append(tf.assign(cache, fresh))
+            batch = tf.matmul(tf.gather(feat, rows), self.weights[w])
+            if name in self.zca_matrices:
+                assert len(self.zca_matrices[name]) == 1, 'stale projections need a single whitening batch'
+                zca = tf.Variable(tf.zeros([self.emb_dim, self.emb_dim]), trainable=False,
+                                  collections=[tf.GraphKeys.LOCAL_VARIABLES], name='stale_zca_' + name)
+                refresh.append(tf.assign(zca, self.zca_matrices[name][0]))
+                batch = tf.matmul(batch, zca)
+            outputs.append(cache + tf.scatter_nd(tf.expand_dims(rows, 1), batch - tf.gather(cache, rows),
+                                                 [self.n_items, self.emb_dim]))
+
+        self.refresh_projections = tf.group(*refresh)
+        return outputs
+
+    def _propagate_towers(self, towers):
+        # towers are (user_embed, item_embed, exponents, n_layers); every group with the same
+        # exponents and depth runs as a single SpMM over its concatenated columns
+        groups = collections.OrderedDict()
+        for t, (_, _, exponents, n_layers) in enumerate(towers):
+            groups.setdefault((tuple(exponents), n_layers), []).append(t)
+
+        outputs = [None] * len(towers)
+        for (exponents, n_layers), members in groups.items():
+            widths = [towers[t][0].get_shape().as_list()[1] for t in members]
+            u_embed = tf.concat([towers[t][0] for t in members], axis=1)
+            i_embed = tf.concat([towers[t][1] for t in members], axis=1)
+
+            for k in range(0, n_layers):
+
+                u_embed, i_embed = self._propagate(u_embed, i_embed, exponents)
+
+            for t, u, i in zip(members, tf.split(u_embed, widths, 1), tf.split(i_embed, widths, 1)):
+                outputs[t] = (u, i)
+
+        return outputs
 
     def _create_norm_embed(self):
 
-        A_fold_hat = self._split_A_hat(self.norm_adj)
-
-        ego_embeddings = tf.concat(
-            [self.weights['user_embedding'], self.weights['item_embedding']], axis=0)
+        u_g_embeddings, i_g_embeddings = self.weights['user_embedding'], self.weights['item_embedding']
 
         for k in range(0, self.n_layers):
 
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings = side_embeddings
-
-        u_g_embeddings, i_g_embeddings = tf.split(ego_embeddings, [self.n_users, self.n_items], 0)
+            u_g_embeddings, i_g_embeddings = self._propagate(u_g_embeddings, i_g_embeddings, self.adj_exp)
 
         return u_g_embeddings, i_g_embeddings
 
-    def _create_norm_embed_v1(self):
-
-        A_fold_hat = self._split_A_hat(self.norm_adj_com)
-
-        ego_embeddings_v = tf.concat([self.um_v1, self.im_v1], axis=0)
-
-        for k in range(0, 1):
-
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings_v))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings_v = side_embeddings
-
-        u_embed, i_embed = tf.split(ego_embeddings_v, [self.n_users, self.n_items], 0)
-
-        return u_embed, i_embed
-
-    def _create_norm_embed_t1(self):
-
-        A_fold_hat = self._split_A_hat(self.norm_adj_com)
-
-        ego_embeddings_t = tf.concat([self.um_t1, self.im_t1], axis=0)
-
-        for k in range(0, 1):
-
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings_t))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings_t = side_embeddings
-
-        u_embed, i_embed = tf.split(ego_embeddings_t, [self.n_users, self.n_items], 0)
-
-        return u_embed, i_embed
-
-    def _create_norm_embed_v2(self):
-
-        A_fold_hat = self._split_A_hat(self.norm_adj_dif)
-
-        ego_embeddings_v = tf.concat([self.um_v2, self.im_v2], axis=0)
-
-        for k in range(0, 1):
-
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings_v))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings_v = side_embeddings
-
-        u_embed, i_embed = tf.split(ego_embeddings_v, [self.n_users, self.n_items], 0)
-
-        return u_embed, i_embed
-
-    def _create_norm_embed_t2(self):
-
-        A_fold_hat = self._split_A_hat(self.norm_adj_dif)
-
-        ego_embeddings_t = tf.concat([self.um_t2, self.im_t2], axis=0)
-
-        for k in range(0, 1):
-
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings_t))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings_t = side_embeddings
-
-        u_embed, i_embed = tf.split(ego_embeddings_t, [self.n_users, self.n_items], 0)
-
-        return u_embed, i_embed
-
     def _create_norm_embed_m(self):
 
-        A_fold_hat = self._split_A_hat(self.norm_adj_m)
-
-        ego_embeddings_m = tf.concat([self.um_m, self.im_m], axis=0)
+        u_embed, i_embed = self.um_m, self.im_m
 
         for k in range(0, 1):
 
-            temp_embed = []
-
-            for f in range(self.n_fold):
-                temp_embed.append(tf.sparse_tensor_dense_matmul(A_fold_hat[f], ego_embeddings_m))
-
-            side_embeddings = tf.concat(temp_embed, 0)
-
-            ego_embeddings_m = side_embeddings
-
-        u_embed, i_embed = tf.split(ego_embeddings_m, [self.n_users, self.n_items], 0)
+            u_embed, i_embed = self._propagate(u_embed, i_embed, self.adj_exp_m)
 
         return u_embed, i_embed
 
@@ -586,10 +640,40 @@ class Model(object):
 
         return cov
 
-    def _convert_sp_mat_to_sp_tensor(self, X):
-        coo = X.tocoo().astype(np.float32)
-        indices = np.mat([coo.row, coo.col]).transpose()
-        return tf.SparseTensor(indices, coo.data, coo.shape)
+    def _local_constant(self, value, dtype, name):
+        # a local (non-checkpointed) variable fed once at initialization, so the array is
+        # neither embedded in the graph as a constant nor copied on every step
+        placeholder = tf.placeholder(dtype, shape=value.shape)
+        self.init_feed[placeholder] = value
+        return tf.Variable(placeholder, trainable=False, collections=[tf.GraphKeys.LOCAL_VARIABLES], name=name)
+
+    def _sp_tensor(self, X, name):
+        # registry keyed by matrix identity, every propagation over X reuses the same SparseTensor
+        if id(X) not in self._sp_tensors:
+            indices, values = self._convert_sp_mat_to_sp_tensor(X, name)
+            sp_tensor = tf.SparseTensor(self._local_constant(indices, tf.int64, name + '_indices'),
+                                        self._local_constant(values, tf.float32, name + '_values'),
+                                        X.shape)
+            self._sp_tensors[id(X)] = (X, sp_tensor)
+        return self._sp_tensors[id(X)][1]
+
+    def _convert_sp_mat_to_sp_tensor(self, X, name=None):
+        cache_file = None
+        if self.sp_cache_dir is not None and name is not None:
+            cache_file = '%s/sp_%s_%dx%d_%d.npz' % (self.sp_cache_dir, name, X.shape[0], X.shape[1], X.nnz)
+            if os.path.exists(cache_file):
+                cached = np.load(cache_file)
+                return cached['indices'], cached['values']
+
+        coo = X.tocoo()
+        indices = np.empty((coo.nnz, 2), dtype=np.int64)
+        indices[:, 0] = coo.row
+        indices[:, 1] = coo.col
+        values = coo.data.astype(np.float32)
+
+        if cache_file is not None:
+            np.savez(cache_file, indices=indices, values=values)
+        return indices, values
 
     def _dropout_sparse(self, X, keep_prob, n_nonzero_elems):
         """
@@ -607,15 +691,26 @@ class Model(object):
 if __name__ == '__main__':
 
     os.environ["CUDA_VISIBLE_DEVICES"] = str(0)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resume', action='store_true', help='continue training from the last checkpoint')
+    args = parser.parse_args()
     # tf.enable_eager_execution()
 
     if not os.path.exists('Log/'):
         os.mkdir('Log/')
     file = open('Log/ours-{}-result-{}-decay={}-layer=5.txt'.format(time.time(), dataset, decay), 'a')
 
+    # per-stage timings, one JSON object per line, appended across runs and commits
+    telemetry = Telemetry('Log/telemetry-{}.jsonl'.format(dataset), dataset=dataset, batch_size=batch_size)
+    telemetry.emit('data_load', data_load_time, edges=data_generator.n_train + data_generator.n_test)
+
     cores = multiprocessing.cpu_count() // 3
     Ks = np.arange(1, 21)
 
+    # forked once per run, before the session and sampler threads exist, and reused by every evaluation
+    eval_pool = MetricsPool(cores, batch_size * 2, 99 + max(len(v) for v in data_generator.test_set.values()), Ks)
+
     data_generator.print_statistics()
     config = dict()
     config['n_users'] = data_generator.n_users
@@ -630,21 +725,56 @@ if __name__ == '__main__':
     ################################################################################
     Generate the Laplacian matrix.
     """
-    norm_left, norm_3, norm_4, norm_5 = data_generator.get_adj_mat()
-
-    config['norm_adj'] = norm_3
-    config['norm_adj_com'] = norm_5
-    config['norm_adj_dif'] = norm_5
-    config['norm_adj_m'] = norm_5
+    with telemetry.stage('adjacency', edges=data_generator.n_train):
+        R, degree = data_generator.get_adj_mat()
+
+    config['R'] = R
+    config['degree'] = degree
+    config['sp_cache_dir'] = data_generator.cache_path
+    config['adj_exp'] = (-0.5, -0.3)
+    config['adj_exp_com'] = (-0.5, -0.5)
+    config['adj_exp_dif'] = (-0.5, -0.5)
+    config['adj_exp_m'] = (-0.5, -0.5)
+    config['stale_steps'] = stale_steps
+
+    # the visual features reach the model through d1, reduced or not
+    img_feat, img_reduce_info = data_generator.imageFeaMatrix, None
+    if img_reduce is not None:
+        t = time.time()
+        img_feat, img_reduce_info = data_generator.reduced_features('img_feat', *img_reduce)
+        telemetry.emit('img_reduce', time.time() - t, **img_reduce_info)
+        file.write('visual features %s: %d -> %d, retained variance %.6f\n' % (
+            img_reduce_info['method'], img_reduce_info['source_dim'], img_reduce_info['dim'],
+            img_reduce_info['retained_variance']))
+    config['img_reduce'] = img_reduce_info
+    config['img_feat_file'] = os.path.abspath('%s/%s.npy' % (data_generator.cache_path,
+                                                            img_reduce_info['name'] if img_reduce_info else 'img_feat'))
 
-    print('shape of adjacency', norm_left.shape)
+    print('shape of interaction matrix', R.shape)
 
     t0 = time.time()
 
-    model = Model(data_config=config,
-                  img_feat=data_generator.imageFeaMatrix,
-                  text_feat=data_generator.textFeatMatrix,
-                  d1=4096, d2=300)
+    # checkpoints hold every global variable (Adam slots included) plus the training state,
+    # --resume restarts the epoch loop and the sampler stream where the last one was taken
+    checkpointer = Checkpointer('Checkpoint/' + dataset)
+    state = None
+    if args.resume:
+        if checkpointer.exists('last'):
+            state = checkpointer.load_state('last')
+        else:
+            print('no checkpoint to resume from, training from scratch')
+    start_epoch = state['epoch'] if state is not None else 0
+
+    n_batch = data_generator.n_train // batch_size + 1
+    sampler = PrefetchSampler(data_generator, seed=2024, block_size=n_batch,
+                              start_batch=state['sampler_batch'] if state is not None else 0)
+
+    with telemetry.stage('graph_build'):
+        model = Model(data_config=config,
+                      img_feat=img_feat,
+                      text_feat=data_generator.textFeatMatrix,
+                      d1=img_feat.shape[1], d2=300,
+                      batch=create_input_pipeline(sampler))
 
     config = tf.ConfigProto()
     config.gpu_options.allow_growth = True
@@ -652,7 +782,14 @@ if __name__ == '__main__':
 
     saver = tf.train.Saver(tf.global_variables())
 
-    sess.run(tf.global_variables_initializer())
+    with telemetry.stage('graph_init'):
+        sess.run(tf.global_variables_initializer())
+        sess.run(tf.local_variables_initializer(), feed_dict=model.init_feed)
+        if state is not None:
+            checkpointer.restore(sess, tf.global_variables(), 'last')
+            print('already resume from epoch', start_epoch)
+        if stale_steps:
+            sess.run(model.refresh_projections)
     cur_best_pre_0 = 0.
 
     """
@@ -669,40 +806,61 @@ if __name__ == '__main__':
     best_score = 0
     best_result = {}
     all_result = {}
+    if state is not None:
+        early_stopping, best_score, best_result = state['early_stopping'], state['best_score'], state['best_result']
+
+    def train_state(next_epoch):
+        return {'epoch': next_epoch, 'sampler_batch': next_epoch * n_batch, 'early_stopping': early_stopping,
+                'best_score': best_score, 'best_result': best_result}
+
+    for epoch in range(start_epoch, 500):
+        if epoch > start_epoch and epoch % save_interval == 0:
+            with telemetry.stage('checkpoint', name='last', epoch=epoch):
+                checkpointer.save(sess, tf.global_variables(), 'last', train_state(epoch))
 
-    for epoch in range(500):
         t1 = time.time()
         loss, mf_loss, emb_loss, kd_loss, fd_loss = 0., 0., 0., 0., 0.
-        n_batch = data_generator.n_train // batch_size + 1
 
+        step_timer = StageTimer()
         for idx in range(n_batch):
-            users, pos_items, neg_items = data_generator.sample_u()
-
-            _, batch_mf_loss, batch_emb_loss, batch_fd_loss = sess.run(
-                [model.opt_1, model.mf_loss, model.emb_loss, model.fd_loss],
-                feed_dict={model.users: users,
-                           model.pos_items: pos_items,
-                           model.neg_items: neg_items
-                           })
+            if stale_steps and (epoch * n_batch + idx) % stale_steps == 0:
+                with step_timer('refresh'):
+                    sess.run(model.refresh_projections)
+            with step_timer('step'):
+                _, batch_mf_loss, batch_emb_loss, batch_fd_loss = sess.run(
+                    [model.opt_1, model.mf_loss, model.emb_loss, model.fd_loss])
             mf_loss += batch_mf_loss
             emb_loss += batch_emb_loss
             fd_loss += batch_fd_loss
 
+        sampler_wait = sampler.pop_wait_time()
+        # edges are the interactions of R swept per step, summed over the epoch
+        telemetry.emit('train_epoch', time.time() - t1, samples=n_batch * batch_size, edges=n_batch * R.nnz,
+                       epoch=epoch, steps=n_batch, step_seconds=step_timer.seconds['step'],
+                       step_max_seconds=step_timer.max['step'], refresh_seconds=step_timer.seconds.get('refresh', 0.),
+                       sampler_wait=sampler_wait)
+
         if np.isnan(mf_loss) == True:
             print('ERROR: loss is nan.')
             sys.exit()
 
         if (epoch + 1) % interval != 0:
-            perf_str = 'Epoch {} [{:.1f}s]: train==[{:.5f} + {:.5f}]'.format(
-                epoch, time.time() - t1,
+            perf_str = 'Epoch {} [{:.1f}s, sampler wait {:.1f}s]: train==[{:.5f} + {:.5f}]'.format(
+                epoch, time.time() - t1, sampler_wait,
                 mf_loss, emb_loss)
             print(perf_str)
             continue
 
         t2 = time.time()
         users_to_test = list(data_generator.test_set.keys())
-
-        result = test(sess, model, users_to_test, data_generator.exist_items, batch_size, cores)
+        if stale_steps:
+            # evaluation and exports see the projections of the current weights
+            sess.run(model.refresh_projections)
+
+        eval_timer = StageTimer()
+        result = test(sess, model, users_to_test, data_generator.exist_items, batch_size, eval_pool, eval_timer)
+        eval_timer.emit(telemetry, 'eval_', epoch=epoch)
+        telemetry.emit('eval', time.time() - t2, samples=len(users_to_test), epoch=epoch)
         hr = result['hit_ratio']
         ndcg = result['ndcg']
 
@@ -714,15 +872,27 @@ if __name__ == '__main__':
             print('best result until now: hr@5,10,20={:.4f},{:.4f},{:.4f},ndcg@5,10,20={:.4f},{:.4f},{:.4f}'.format(
                 hr[4], hr[9], hr[19], ndcg[4], ndcg[9], ndcg[19]))
             early_stopping = 0
+            with telemetry.stage('checkpoint', name='best', epoch=epoch):
+                checkpointer.save(sess, tf.global_variables(), 'best', train_state(epoch + 1))
         else:
             early_stopping += 1
 
         t3 = time.time()
 
-        perf_str = 'Epoch {} [{:1f}s + {:1f}s]: hit@5=[{:5f}],hit@10=[{:5f}],hit@20=[{:5f}],ndcg@5=[{:5f}],ndcg@10=[{:5f}],ndcg@20=[{:5f}]'.format(epoch, t2 - t1, t3 - t2,
+        perf_str = 'Epoch {} [{:1f}s + {:1f}s, sampler wait {:1f}s]: hit@5=[{:5f}],hit@10=[{:5f}],hit@20=[{:5f}],ndcg@5=[{:5f}],ndcg@10=[{:5f}],ndcg@20=[{:5f}]'.format(epoch, t2 - t1, t3 - t2, sampler_wait,
                     hr[4], hr[9], hr[19], ndcg[4], ndcg[9], ndcg[19])
         print(perf_str)
         file.write(perf_str + '\n')
+
+        if full_ranking:
+            t4 = time.time()
+            result['full'] = test_full(sess, model, users_to_test, batch_size, item_chunk)
+            telemetry.emit('eval_full', time.time() - t4, samples=len(users_to_test), epoch=epoch)
+            perf_str = 'Epoch {} full ranking [{:1f}s]: recall@10=[{:5f}],recall@20=[{:5f}],ndcg@10=[{:5f}],ndcg@20=[{:5f}]'.format(
+                epoch, time.time() - t4, result['full']['recall'][9], result['full']['recall'][19],
+                result['full']['ndcg'][9], result['full']['ndcg'][19])
+            print(perf_str)
+            file.write(perf_str + '\n')
         all_result[epoch + 1] = result
         if early_stopping == 5:
             break
@@ -733,3 +903,19 @@ if __name__ == '__main__':
     print(best_perf_str)
     file.write(best_perf_str + '\n')
     file.close()
+    eval_pool.close()
+    with telemetry.stage('checkpoint_flush'):
+        checkpointer.close()
+
+    # exported once, from the best checkpoint, instead of on every improvement during training
+    if checkpointer.exists('best'):
+        with telemetry.stage('export'):
+            checkpointer.restore(sess, tf.global_variables(), 'best')
+            if stale_steps:
+                sess.run(model.refresh_projections)
+            export_embeddings(sess, model, 'Export/' + dataset)
+            export_model(sess, model, 'Export/' + dataset)
+
+    # releases the tf.data generator iterator while the interpreter is still alive
+    sess.close()
+    telemetry.close()